@@ -5,11 +5,16 @@ import subprocess
 import sys
 import random
 import re
+import time
 # from cv2 import cv2
 import cv2
+import numpy as np
+import onnxruntime as ort
 from dateutil.parser import parse
 from numba import njit
+from PIL import Image
 from rembg import remove
+from rembg.sessions import sessions_class
 from screeninfo import get_monitors
 from collections import defaultdict
 
@@ -84,15 +89,381 @@ def get_screen_settings():
             return int(str(m).split('width=')[-1][:4]), int(str(m).split('height=')[-1][:4])
 
 
-def delete_background(initial_image):
+rembg_models = {'u2net': 'u2net', 'u2netp': 'u2netp', 'silueta': 'silueta', 'isnet': 'isnet-general-use'}
+_rembg_sessions = {}  # rembg sessions loaded in the current process, see get_rembg_session
+_worker_session = None  # rembg session of a process pool worker, see init_background_worker
+_image_sizes = {}  # Image dimensions read from the file headers, see image_size
+
+
+def get_rembg_session(model_name='u2net', intra_op_threads=0, inter_op_threads=0):
+    """
+    Get a rembg session. A model is loaded once per process and per threads settings, the later calls reuse it
+    :param model_name: 'u2net', 'u2netp', 'silueta', 'isnet' or any other rembg model name
+    :param intra_op_threads: ONNX Runtime threads used to parallelize an operator. 0 lets ONNX Runtime decide
+    :param inter_op_threads: ONNX Runtime threads used to run operators in parallel. 0 lets ONNX Runtime decide
+    :return: rembg session
     """
-    Delete background on an image using rembg (https://github.com/danielgatis/rembg)
+    model_name = rembg_models.get(model_name, model_name)
+    key = (model_name, intra_op_threads, inter_op_threads)
+    if key not in _rembg_sessions:
+        session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+        if session_class is None:
+            raise ValueError(f'Unknown rembg model: {model_name}')
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = intra_op_threads
+        sess_opts.inter_op_num_threads = inter_op_threads
+        _rembg_sessions[key] = session_class(model_name, sess_opts)
+    return _rembg_sessions[key]
+
+
+def delete_background(initial_image, session=None, model_name='u2net', engine='rembg', mask_size=1024,
+                      fallback='rembg', min_confidence=0.8, return_info=False):
+    """
+    Delete background on an image. The engine is taken from the background_engines, so a new one can be plugged in
+    there. Engines reporting their confidence fall back to the fallback engine if the confidence is too low
     :param initial_image: CV2 image. If given as str - open in cv2
+    :param session: rembg session to use. If None, the session of the model_name is taken from get_rembg_session
+    :param model_name: rembg model name, used only if no session is given
+    :param engine: 'rembg' - rembg (https://github.com/danielgatis/rembg) works on the full resolution image,
+                   'mask' - rembg predicts only a mask on the downscaled image, see delete_background_low_res,
+                   'classical' - the classical segmentation of uniform background, see delete_background_classical
+    :param mask_size: The longest side of the downscaled image for the 'mask' and 'classical' engines
+    :param fallback: Engine used if the confidence of the engine is too low. None keeps the result anyway
+    :param min_confidence: The lowest confidence from 0 to 1 to accept the result of the engine
+    :param return_info: Return also dict with the engine actually used and its confidence
     :return: Image with erased background
     """
     if type(initial_image) is str:  # If the input is str read an image
-        initial_image = cv2.imread(initial_image)
-    return remove(initial_image)
+        path, initial_image = initial_image, cv2.imread(initial_image)
+        if initial_image is None:  # cv2 does not raise on an unreadable or corrupt file
+            raise ValueError(f'Cannot read {path}')
+    settings = {'session': session, 'model_name': model_name, 'mask_size': mask_size,
+                'min_confidence': min_confidence if fallback else 0}
+    clear_img, confidence = background_engines[engine](initial_image, **settings)
+    used_engine = engine
+    if fallback and (clear_img is None or (confidence is not None and confidence < min_confidence)):
+        clear_img, _ = background_engines[fallback](initial_image, **settings)
+        used_engine = fallback
+    if return_info:
+        return clear_img, {'Engine': used_engine, 'Confidence': confidence}
+    return clear_img
+
+
+def rembg_engine(initial_image, session=None, model_name='u2net', **settings):
+    """
+    Background engine erasing with rembg on the full resolution image
+    :return: Image with erased background and no confidence
+    """
+    return remove(initial_image, session=session or get_rembg_session(model_name)), None
+
+
+def mask_engine(initial_image, session=None, model_name='u2net', mask_size=1024, **settings):
+    """
+    Background engine predicting with rembg only a mask on the downscaled image
+    :return: Image with erased background and no confidence
+    """
+    return delete_background_low_res(initial_image, session or get_rembg_session(model_name), mask_size), None
+
+
+def classical_engine(initial_image, mask_size=1024, min_confidence=0, **settings):
+    """
+    Background engine segmenting uniform background without a neural network
+    :return: Image with erased background (None if the confidence is below the min_confidence) and the confidence
+    """
+    return delete_background_classical(initial_image, mask_size, min_confidence)
+
+
+background_engines = {'rembg': rembg_engine, 'mask': mask_engine, 'classical': classical_engine}
+
+
+def delete_background_low_res(initial_image, session, mask_size=1024):
+    """
+    Delete background predicting the alpha mask on a downscaled image. rembg models work at 320-1024 px anyway, so
+    the full resolution image is never passed to rembg. The mask is upsampled and refined at the full resolution with
+    a guided filter and applied to the original pixels the same way rembg does it
+    :param initial_image: CV2 image, BGR or BGRA
+    :param session: rembg session
+    :param mask_size: The longest side of the downscaled image
+    :return: BGRA image with erased background
+    """
+    small_image = downscale_image(initial_image, mask_size)
+    small_mask = remove(small_image, session=session, only_mask=True)
+    return apply_mask(initial_image, guided_upsampling(to_gray(initial_image), to_gray(small_image), small_mask))
+
+
+def delete_background_classical(initial_image, mask_size=1024, min_confidence=0, border=0.02):
+    """
+    Delete uniform background with a classical segmentation, taking milliseconds instead of seconds of rembg.
+    The background color is estimated as the median of the image borders. Pixels are split by their LAB color distance
+    to it with the Otsu threshold and the largest object is kept, holes filled. The segmentation works on the
+    downscaled image, the mask is upsampled with guided_upsampling.
+    The confidence is the Otsu separability of the distances (between-class to total variance) multiplied by the share
+    of the border pixels classified as background. It is 0 if the object takes less than 1% or more than 90% of
+    the image
+    :param initial_image: CV2 image, BGR or BGRA
+    :param mask_size: The longest side of the downscaled image
+    :param min_confidence: If the confidence is lower, the full resolution image is not generated at all
+    :param border: Width of the borders to estimate the background color, as a share of the shorter side
+    :return: BGRA image with erased background (or None) and the confidence from 0 to 1
+    """
+    small_image = downscale_image(initial_image, mask_size)
+    lab = cv2.cvtColor(small_image[:, :, :3].copy(), cv2.COLOR_BGR2LAB).astype(np.float32)
+    height, width = lab.shape[:2]
+    border_px = max(1, round(border * min(height, width)))
+    border_mask = np.zeros((height, width), dtype=bool)
+    border_mask[:border_px], border_mask[-border_px:] = True, True
+    border_mask[:, :border_px], border_mask[:, -border_px:] = True, True
+    background_color = np.median(lab[border_mask], axis=0)
+    distance = np.linalg.norm(lab - background_color, axis=2)
+    distance = cv2.normalize(distance, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    _, binary = cv2.threshold(distance, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    foreground = binary > 0
+    foreground_share = foreground.mean()
+    if foreground_share in (0, 1) or distance.var() == 0:
+        return None, 0.0
+    between_class_var = foreground_share * (1 - foreground_share) * \
+        (distance[foreground].mean() - distance[~foreground].mean()) ** 2
+    separability = between_class_var / distance.var()
+    clean_border = 1 - foreground[border_mask].mean()
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    small_mask = np.zeros_like(binary)
+    cv2.drawContours(small_mask, [max(contours, key=cv2.contourArea)], -1, 255, cv2.FILLED)
+    object_share = np.count_nonzero(small_mask) / small_mask.size
+    confidence = float(separability * clean_border) if 0.01 < object_share < 0.9 else 0.0
+    if confidence < min_confidence:
+        return None, confidence
+    return apply_mask(initial_image, guided_upsampling(to_gray(initial_image), to_gray(small_image),
+                                                       small_mask)), confidence
+
+
+def downscale_image(initial_image, size):
+    """
+    Downscale an image so its longest side is not longer than the size
+    :param initial_image: CV2 image
+    :param size: The longest side
+    :return: Downscaled image
+    """
+    height, width = initial_image.shape[:2]
+    scale = min(1.0, size / max(height, width))
+    return cv2.resize(initial_image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def to_gray(initial_image):
+    return cv2.cvtColor(initial_image, cv2.COLOR_BGR2GRAY if initial_image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+
+
+def apply_mask(initial_image, mask):
+    """
+    Apply an alpha mask to an image the same way rembg does it: colors are multiplied by the mask
+    :param initial_image: CV2 image, BGR or BGRA
+    :param mask: Alpha mask
+    :return: BGRA image
+    """
+    if initial_image.shape[2] == 4:  # Keep the background erased on the previous cycles
+        mask = cv2.multiply(mask, initial_image[:, :, 3], scale=1 / 255)
+    colors = cv2.multiply(initial_image[:, :, :3], cv2.merge([mask, mask, mask]), scale=1 / 255)
+    return cv2.merge([colors, mask])
+
+
+def guided_upsampling(guide, small_guide, small_mask, radius=4, eps=1e-3):
+    """
+    Upsample a mask with the fast guided filter (https://arxiv.org/abs/1505.00996). The linear coefficients are found
+    on the small images and applied to the full resolution guide, so the mask edges follow the edges of the image
+    :param guide: Full resolution grayscale image
+    :param small_guide: Downscaled grayscale image
+    :param small_mask: Mask predicted on the downscaled image
+    :param radius: Radius of the filter on the downscaled image
+    :param eps: Regularization, the higher the smoother the mask
+    :return: Full resolution mask
+    """
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    small_i = small_guide.astype(np.float32) / 255
+    small_p = small_mask.astype(np.float32) / 255
+    mean_i = cv2.boxFilter(small_i, -1, ksize)
+    mean_p = cv2.boxFilter(small_p, -1, ksize)
+    var_i = cv2.boxFilter(small_i * small_i, -1, ksize) - mean_i * mean_i
+    cov_ip = cv2.boxFilter(small_i * small_p, -1, ksize) - mean_i * mean_p
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    height, width = guide.shape[:2]
+    mean_a = cv2.resize(cv2.boxFilter(a, -1, ksize), (width, height), interpolation=cv2.INTER_LINEAR)
+    mean_b = cv2.resize(cv2.boxFilter(b, -1, ksize), (width, height), interpolation=cv2.INTER_LINEAR)
+    mask = guide.astype(np.float32)
+    mask *= mean_a
+    del mean_a
+    mask += mean_b * 255
+    return np.clip(mask, 0, 255, out=mask).round().astype(np.uint8)
+
+
+def init_background_worker(model_name='u2net', intra_op_threads=0, inter_op_threads=0):
+    """
+    Initializer of a process pool worker. Load a rembg model once, so the worker keeps it for all its images
+    :param model_name: rembg model name
+    :param intra_op_threads: ONNX Runtime intra-op threads of the worker
+    :param inter_op_threads: ONNX Runtime inter-op threads of the worker
+    :return: None
+    """
+    global _worker_session
+    _worker_session = get_rembg_session(model_name, intra_op_threads, inter_op_threads)
+
+
+def delete_background_cycles(initial_image, cycles=1, session=None, convergence=None, **settings):
+    """
+    Delete background on an image several times in a row. Also meant to be run by process pool workers prepared with
+    init_background_worker.
+    If the convergence is given, the cycles stop as soon as the alpha masks of two consecutive cycles are similar
+    enough, so the cycles are only the upper bound. If the engine falls back, the next cycles use the fallback engine
+    :param initial_image: CV2 image. If given as str - open in cv2
+    :param cycles: Number of background erasing cycles
+    :param session: rembg session to use. If None, the session of the process pool worker is used
+    :param convergence: IoU of two consecutive alpha masks to consider the mask converged. None runs all the cycles
+    :param settings: Settings of delete_background: engine, mask_size, fallback, min_confidence
+    :return: Image with erased background and dict with info about erasing: number of cycles actually used,
+             engine used and its confidence, time of every cycle and the total time in seconds
+    """
+    session = session or _worker_session
+    previous_mask = None
+    cycle, info, cycle_times = 0, {}, []
+    start_time = time.perf_counter()
+    for cycle in range(1, cycles + 1):
+        cycle_start = time.perf_counter()
+        initial_image, info = delete_background(initial_image, session=session, return_info=True, **settings)
+        cycle_times.append(time.perf_counter() - cycle_start)
+        if initial_image is None:
+            raise ValueError(f"The {info['Engine']} engine returned no image")
+        if info['Engine'] == 'classical':  # The classical segmentation does not change on the next cycles
+            break
+        settings['engine'] = info['Engine']
+        if convergence is not None:
+            mask = initial_image[:, :, 3] > 127
+            if previous_mask is not None and masks_iou(previous_mask, mask) >= convergence:
+                break
+            previous_mask = mask
+    return initial_image, {'Cycles': cycle, **info, 'Cycle times': cycle_times,
+                           'Time': time.perf_counter() - start_time}
+
+
+def delete_background_safely(initial_image, **settings):
+    """
+    Run delete_background_cycles so that a failed image does not stop the others, e.g. in a process pool
+    :param initial_image: CV2 image or path to it
+    :param settings: Settings of delete_background_cycles
+    :return: Image with erased background or None and dict with info about erasing or with the 'Error'
+    """
+    try:
+        return delete_background_cycles(initial_image, **settings)
+    except Exception as e:
+        return None, {'Error': repr(e)}
+
+
+def masks_iou(mask_1, mask_2):
+    """
+    Intersection over union of two boolean masks
+    :param mask_1: First mask
+    :param mask_2: Second mask
+    :return: IoU, 1 for two empty masks
+    """
+    union = np.count_nonzero(mask_1 | mask_2)
+    if not union:
+        return 1.0
+    return np.count_nonzero(mask_1 & mask_2) / union
+
+
+def image_size(path):
+    """
+    Get the dimensions of an image from its file header without decoding the pixels. The result is cached per path and
+    refreshed if the file has been changed
+    :param path: Path to the image
+    :return: height, width, channels or None if the file is not a readable image
+    """
+    try:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = _image_sizes.get(key)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        with Image.open(path) as img:  # Only the header is read until the pixels are accessed
+            width, height = img.size
+            channels = len(img.getbands())
+    except (OSError, ValueError):
+        return None
+    _image_sizes[key] = (stat.st_mtime_ns, stat.st_size), (height, width, channels)
+    return height, width, channels
+
+
+mask_suffixes = ('_mask.png', '_mask.npz')  # Masks stored next to the color images, see load_frame
+
+
+def is_mask_file(path):
+    return path.endswith(mask_suffixes)
+
+
+def find_mask(path):
+    """
+    Find the mask stored next to a color image, e.g. '3-120_mask.png' for '3-120.jpg'
+    :param path: Path to the color image
+    :return: Path to the mask or None if there is no mask
+    """
+    stem = os.path.splitext(path)[0]
+    for suffix in mask_suffixes:
+        if os.path.isfile(stem + suffix):
+            return stem + suffix
+    return None
+
+
+def save_packed_mask(path, mask):
+    """
+    Save a mask as 1 bit per pixel in a compressed .npz file
+    :param path: Path to the .npz file
+    :param mask: 8-bit mask, the pixels above 127 are kept
+    :return: None
+    """
+    mask = np.asarray(mask) > 127
+    np.savez_compressed(path, shape=mask.shape, bits=np.packbits(mask))
+
+
+def load_mask(path):
+    """
+    Load a mask saved as a grayscale image or with save_packed_mask
+    :param path: Path to the mask
+    :return: 8-bit mask or None if the mask is not readable
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            shape = tuple(data['shape'])
+            return np.unpackbits(data['bits'], count=int(np.prod(shape))).reshape(shape) * np.uint8(255)
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+
+def load_frame(path):
+    """
+    Open a processed frame in cv2. If the frame is stored as a color image and a mask, they are put together
+    :param path: Path to the frame, the color image for the frames stored with a mask
+    :return: BGR or BGRA image or None if the image is not readable
+    """
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    mask_path = find_mask(path)
+    if img is None or mask_path is None:
+        return img
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return np.dstack((img[:, :, :3], load_mask(mask_path)))
+
+
+def open_frame(path):
+    """
+    Open a processed frame in PIL. If the frame is stored as a color image and a mask, they are put together
+    :param path: Path to the frame, the color image for the frames stored with a mask
+    :return: PIL image, RGBA for the frames stored with a mask
+    """
+    img = Image.open(path)
+    mask_path = find_mask(path)
+    if mask_path is None:
+        return img
+    img = img.convert('RGB')
+    img.putalpha(Image.fromarray(load_mask(mask_path)))
+    return img
 
 
 def open_file(path_to_file):
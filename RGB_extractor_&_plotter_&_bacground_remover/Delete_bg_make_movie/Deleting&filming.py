@@ -1,60 +1,297 @@
 import json
 import math
 import re
+import shutil
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from imutils import perspective
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
+from Film_writer import FilmWriter
+from Frames_cache import ErasedFramesCache
+from Image_writer import AsyncImageWriter
+from Stage_profiler import StageProfiler
 from Instruments import *
 
 
 class RemoveBackgroundMakeFilm:
-    def __init__(self, parent_path: str, cycles=3, film='y', open_logs=False, frame_rate=1):
+    manifest_interval = 10  # Frames recorded between the manifest saves
+
+    def __init__(self, parent_path: str, cycles=3, film='y', open_logs=False, frame_rate=1, workers=1,
+                 model_name='u2net', intra_op_threads=0, inter_op_threads=0, streaming=False,
+                 cache=True, cache_path=None, cache_size_gb=30, convergence=None, engine='rembg', mask_size=1024,
+                 fallback='rembg', min_confidence=0.8, folder_workers=1, target_folders=None, progress=True,
+                 summary=True, codec='MJPG', renditions=None, frame_format='png', png_compression=1,
+                 image_writers=4, mask_format='png', frame_quality=95, frame_stack=False, resume=False,
+                 geometry_size=1024, min_area_fraction=0.004, refine_geometry=False):
+        self.settings = {key: value for key, value in locals().items() if key not in ('self', '__class__')}
         if not parent_path.endswith('/'):
             parent_path = parent_path + '/'
+        self.parent_path = parent_path
         self.extension = '.jpg'
-        self.extension_out = '.png'  # Keep the output extension as ".png" to apply the alpha channel
+        if frame_format not in ('png', 'webp', 'jpg+mask', 'webp+mask'):
+            raise ValueError(f"Unknown frame format {frame_format}. Choose 'png', 'webp', 'jpg+mask' or 'webp+mask'")
+        if mask_format not in ('png', 'npz'):
+            raise ValueError(f"Unknown mask format {mask_format}. Choose 'png' (8 bit) or 'npz' (1 bit)")
+        # 'png' and 'webp' (lossless) keep the alpha channel in the frame. '+mask' formats keep the color crop as
+        # a lossy image of the frame_quality and the alpha channel as a separate '<frame>_mask.png' or '.npz' mask
+        color_format, _, with_mask = frame_format.partition('+')
+        self.extension_out = '.' + color_format
+        self.mask_extension = f'_mask.{mask_format}' if with_mask else None
+        self.frame_quality = frame_quality
+        self.frame_stack = frame_stack  # Also save all the processed frames as a single 'Frames.npy' RGBA stack
+        self.png_compression = png_compression  # 0 - the fastest saving and the largest files, 9 - the opposite
+        self.image_writers = image_writers  # Number of threads saving the processed images
         self.frame_rate = frame_rate
+        self.target_folders = target_folders or []  # Process only these folders (names or paths) if given
         self.path = self.check_path(parent_path)
         self.folder = None
         self.cycles = cycles  # Cycles are NOT specified folder specifically
+        self.convergence = convergence  # IoU of the masks of two consecutive cycles to stop erasing an image earlier
+        self.workers = workers  # Number of processes erasing background. 1 keeps everything in the main process
+        self.model_name = model_name  # rembg model: 'u2net', 'u2netp', 'silueta' or 'isnet'
+        self.engine = engine  # 'rembg', 'mask' or 'classical', see Instruments.delete_background
+        self.mask_size = mask_size  # The longest side of the downscaled image for the 'mask' and 'classical' engines
+        self.fallback = fallback  # Engine for the frames the 'classical' engine is not confident about
+        self.min_confidence = min_confidence
+        self.intra_op_threads = intra_op_threads  # ONNX Runtime threads per erasing process, 0 - ONNX Runtime decides
+        self.inter_op_threads = inter_op_threads
+        self.streaming = streaming  # Keep only a few frames in memory, the erased ones are put aside to the disk
+        self.resume = resume  # Skip the frames finished by the previous run according to the manifest
+        self.geometry_size = geometry_size  # The longest side of the mask the geometry is found on, 0 - full size
+        self.min_area_fraction = min_area_fraction  # The smallest device area as a fraction of the picture area
+        self.refine_geometry = refine_geometry  # Refine the device rectangle at full resolution around the device
+        self.cache = ErasedFramesCache(cache_path, cache_size_gb) if cache else None  # Skip already erased pictures
         self.sizes_pd = None
         self.film = film
+        self.codec = codec  # Film codec: 'MJPG', 'H264' (needs ffmpeg), 'FFV1' (lossless) or 'RAW', see FilmWriter
+        # Films made at once from the same frames, e.g. [{}, {'width': 640, 'frame_rate': 5, 'codec': 'GIF'}]. Keys
+        # are 'codec', 'frame_rate', 'scale', 'width' and 'name'. The missing ones are taken from the film settings
+        self.renditions = renditions or [{}]
+        self.folder_workers = folder_workers  # Number of sample folders processed at once in separate processes
+        self.progress = progress  # Show the progress bars
         self.log_files = []
-        pbar_main = tqdm(self.path, desc=f'Working in {os.path.basename(os.path.normpath(parent_path))}',
-                         position=0, ncols=100, unit='directory', colour='#ffc25c')  # unit_scale=True)
-        for folder in pbar_main:
-            self.start_time = time.time()
-            self.folder = folder + '/'
-            self.path_out = self.folder + "Processed/"
-            self.samples, self.pre_processed, self.sizes, self.center, self.no_background, self.cropped, \
-                self.error_list = [], [], [], [], [], [], []
-            self.sample_name = os.path.basename(os.path.normpath(self.folder))
-            pbar_main.set_description(f'Working on {self.sample_name}')
-            self.video_name = f'Ageing {self.sample_name}.avi'
-            for file in os.listdir(self.folder):
-                if file.endswith(self.extension):
-                    self.samples.append(file)
-            self.time_line = self.timeline_detector()
-            self.file_sorting()
-            self.erase_background()
-            self.processing_images()
-            self.sizes_pd = pd.DataFrame(self.sizes)
-            self.crop_images()
-            self.executed_time = time.time()
-            if film == 'y':
-                self.create_video()
-            self.log_file()
+        self.run_summary = []
+        if self.folder_workers > 1 and len(self.path) > 1:
+            self.process_folders_parallel()
+        else:
+            pbar_main = tqdm(self.path, desc=f'Working in {os.path.basename(os.path.normpath(parent_path))}',
+                             position=0, ncols=100, unit='directory', colour='#ffc25c',
+                             disable=not self.progress)  # unit_scale=True)
+            for folder in pbar_main:
+                pbar_main.set_description(f'Working on {os.path.basename(os.path.normpath(folder))}')
+                self.run_summary.append(self.process_folder_safely(folder))
+        if summary:
+            self.write_run_summary()
         if open_logs:
             for log in self.log_files:
                 open_file(log)
                 time.sleep(.1)
 
+    def process_folder(self, folder):
+        """
+        Run the whole pipeline for a single sample folder. A frame failed at any stage is quarantined with its error,
+        the rest of the frames go on. The progress is recorded in the manifest, see load_manifest
+        :param folder: Path to the folder
+        :return: None
+        """
+        self.start_time = time.time()
+        self.folder = folder + '/'
+        self.path_out = self.folder + "Processed/"
+        self.samples, self.no_background, self.error_list = [], {}, []
+        self.failed = {}  # Quarantined frames: index - stage and error
+        self.sample_name = os.path.basename(os.path.normpath(self.folder))
+        self.videos = []
+        self.profiler = StageProfiler()
+        for file in os.listdir(self.folder):
+            if file.endswith(self.extension):
+                self.samples.append(file)
+        with self.profiler.stage('Timeline detection'):
+            self.time_line = self.timeline_detector()
+        with self.profiler.stage('Sorting'):
+            self.file_sorting()
+        frames = len(self.samples)
+        self.geometry, self.cropped = [None] * frames, [None] * frames
+        self.erasing_info = [{} for _ in range(frames)]
+        create_folder(self.folder, "Processed")
+        self.manifest = self.load_manifest()
+        self.unsaved_records = 0
+        to_process = [index for index in range(frames) if self.geometry[index] is None]
+        self.resumed = frames - len(to_process)
+        if self.streaming:
+            with self.profiler.stage('Erasing and geometry'):
+                self.streaming_geometry(to_process)
+        else:
+            with self.profiler.stage('Erasing'):
+                self.erase_background(to_process)
+            with self.profiler.stage('Geometry'):
+                self.processing_images(to_process)
+        self.save_manifest()
+        good = self.good_frames()
+        if not good:
+            raise ValueError(f'All the frames have failed, see {self.path_out}Manifest.json')
+        self.sizes = [self.set_cropping_shape(self.geometry[i]['corners'], self.geometry[i]['center']) for i in good]
+        self.sizes_pd = pd.DataFrame(self.sizes)
+        self.crop_images()
+        self.save_manifest()
+        if self.streaming:
+            shutil.rmtree(self.path_out + 'Erased', ignore_errors=True)
+        self.executed_time = time.time()
+        self.log_file()
+
+    def process_folder_safely(self, folder):
+        """
+        Process a sample folder so that its failure does not stop processing of the others
+        :param folder: Path to the folder
+        :return: dict with the summary of the folder
+        """
+        start_time = time.time()
+        try:
+            self.process_folder(folder)
+        except Exception as e:
+            print(f'\n{os.path.basename(os.path.normpath(folder))} failed: {e!r}')
+            return {'Folder': folder, 'Status': 'Failed', 'Error': repr(e), 'Time': time.time() - start_time}
+        finally:
+            self.no_background = {}  # Do not keep the frames of the finished folder in memory
+        return {'Folder': folder, 'Status': 'Done', 'Images': len(self.samples), 'Errors': self.error_list,
+                'Quarantined': {self.samples[index]: failure for index, failure in self.failed.items()},
+                'Log': self.log_files[-1], 'Time': time.time() - start_time}
+
+    def process_folders_parallel(self):
+        """
+        Process whole sample folders concurrently in a pool of processes. Each folder is processed by its own
+        RemoveBackgroundMakeFilm without progress bars, their progress is combined into a single progress bar
+        :return: None
+        """
+        settings = dict(self.settings, folder_workers=1, progress=False, summary=False, open_logs=False)
+        if not settings['intra_op_threads']:  # Split the CPU cores between all the erasing processes
+            settings['intra_op_threads'] = max(1, (os.cpu_count() or 1) // (self.folder_workers * self.workers))
+            settings['inter_op_threads'] = settings['inter_op_threads'] or 1
+        with ProcessPoolExecutor(max_workers=self.folder_workers) as executor:
+            futures = {executor.submit(process_folder_job, settings, folder): folder for folder in self.path}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f'Working on {self.folder_workers} '
+                               f'folders at once', position=0, ncols=100, unit='directory', colour='#ffc25c',
+                               disable=not self.progress):
+                try:
+                    folder_summary = future.result()
+                except Exception as e:  # The process itself has died
+                    folder_summary = {'Folder': futures[future], 'Status': 'Failed', 'Error': repr(e)}
+                self.run_summary.append(folder_summary)
+                if folder_summary.get('Log'):
+                    self.log_files.append(folder_summary['Log'])
+        self.run_summary.sort(key=lambda folder_summary: self.path.index(folder_summary['Folder']))
+
+    def write_run_summary(self):
+        """
+        Print the summary of the run and save it to the 'Run summary' json file in the parent folder
+        :return: None
+        """
+        today = f'{datetime.now():%Y-%m-%d %H.%M.%S%z}'
+        failed = [folder_summary for folder_summary in self.run_summary if folder_summary['Status'] == 'Failed']
+        print(f'\nProcessed {len(self.run_summary) - len(failed)} of {len(self.run_summary)} folders')
+        for folder_summary in failed:
+            print(f"Failed: {folder_summary['Folder']}. {folder_summary['Error']}")
+        with open(f'{self.parent_path}Run summary {today}.json', 'w') as f:
+            json.dump(self.run_summary, f, indent=4)
+
+    def load_manifest(self):
+        """
+        Load the manifest of the previous run from the 'Manifest.json' in the output folder. For every frame the
+        manifest records the source picture state, the erasing info, the geometry, the cropped image and the error if
+        the frame has been quarantined. In the resume mode the erasing info and the geometry of the frames finished
+        before are restored, so they are neither erased nor measured again. The quarantined, new and changed frames
+        are processed again. A manifest made with other erasing or geometry settings is not used
+        :return: dict with the manifest
+        """
+        manifest = {'Erasing settings': [str(setting) for setting in self.erasing_settings()],
+                    'Geometry settings': [self.geometry_size, self.min_area_fraction, self.refine_geometry],
+                    'Output settings': self.output_settings(), 'Crop extent': None, 'Frames': {}}
+        manifest_path = self.path_out + 'Manifest.json'
+        if not self.resume or not os.path.isfile(manifest_path):
+            return manifest
+        try:
+            with open(manifest_path, 'r') as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:  # A broken manifest is the same as no manifest
+            tqdm.write(f'{manifest_path} is not readable, all the frames are processed: {e!r}')
+            return manifest
+        if previous.get('Erasing settings') != manifest['Erasing settings'] or \
+                previous.get('Geometry settings') != manifest['Geometry settings']:
+            return manifest
+        if previous.get('Output settings') == manifest['Output settings']:
+            manifest['Crop extent'] = previous.get('Crop extent')
+        for index, sample in enumerate(self.samples):
+            entry = previous['Frames'].get(sample)
+            if not entry or 'Error' in entry or 'Geometry' not in entry or entry.get('Source') != self.source_state(
+                    sample):
+                continue
+            manifest['Frames'][sample] = entry
+            self.geometry[index] = self.geometry_from_json(entry['Geometry'])
+            self.erasing_info[index] = entry.get('Erasing', {})
+        return manifest
+
+    def save_manifest(self):
+        """
+        Save the manifest to the 'Manifest.json' in the output folder. It is written to a temporary file first, so an
+        interrupted run never leaves a broken manifest behind
+        :return: None
+        """
+        manifest_path = self.path_out + 'Manifest.json'
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self.unsaved_records = 0
+
+    def output_settings(self):
+        """
+        Settings the processed frames depend on besides the erasing settings
+        :return: List of settings
+        """
+        return [self.extension_out, self.mask_extension, self.frame_quality]
+
+    def source_state(self, sample):
+        stat = os.stat(self.folder + sample)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def record_frame(self, index, **fields):
+        """
+        Record the progress of a frame in the manifest. The manifest is saved every manifest_interval records, so an
+        interrupted run loses only the last few frames
+        :param index: Index of the frame
+        :param fields: Fields to record, e.g. Erasing, Geometry or Cropped
+        :return: None
+        """
+        sample = self.samples[index]
+        entry = self.manifest['Frames'].setdefault(sample, {'Source': self.source_state(sample)})
+        entry.update(fields)
+        self.unsaved_records += 1
+        if self.unsaved_records >= self.manifest_interval:
+            self.save_manifest()
+
+    def quarantine(self, index, stage, error):
+        """
+        Exclude a failed frame from the further processing and record its error
+        :param index: Index of the frame
+        :param stage: Stage the frame has failed at
+        :param error: Error description
+        :return: None
+        """
+        self.failed[index] = {'Stage': stage, 'Error': error}
+        self.record_frame(index, Error=self.failed[index])
+        self.manifest['Frames'][self.samples[index]].pop('Cropped', None)
+        self.no_background.pop(index, None)
+        tqdm.write(f'{self.samples[index]} is quarantined. {stage}: {error}')
+
+    def good_frames(self):
+        return [index for index in range(len(self.samples)) if index not in self.failed]
+
     def log_file(self):
         """
         Generate a log file contain some useful information for each device.
@@ -68,105 +305,276 @@ class RemoveBackgroundMakeFilm:
             log.write(f"Date: {today}\n\n")
             log.write(f"Source folder: {self.folder}\n")
             log.write(f'Initial images (w, h, ch) turned to (w, h, ch):\n')
-            skipped_img_index = []
             for i, j in enumerate(self.samples):
-                try:
-                    max_time_len = len(str(self.time_line.iat[-1, 0]))
-                    final_image_name = (max_time_len - len(str(self.time_line.iat[i, 0]))) * ' ' \
-                                       + str(i) + '-' + str(
-                        self.time_line.iat[i, 0])  # Add spaces from the left to align names
-                    log.write(f"{i + 1}. {j} {self.img_shape(self.folder + j)}"
-                              f"\t{final_image_name}{self.extension_out} {self.img_shape(self.cropped[i])}\n")
-                except AttributeError:
-                    log.write(f'{i + 1}. Empty image\t{final_image_name}{self.extension_out}\n')
-                    skipped_img_index.append(i + 1)
-            if skipped_img_index:
+                max_time_len = len(str(self.time_line.iat[-1, 0]))
+                final_image_name = (max_time_len - len(str(self.time_line.iat[i, 0]))) * ' ' \
+                                   + str(i) + '-' + str(
+                    self.time_line.iat[i, 0])  # Add spaces from the left to align names
+                if i in self.failed:
+                    log.write(f'{i + 1}. {j} quarantined\t{final_image_name}{self.extension_out}\n')
+                    continue
+                log.write(f"{i + 1}. {j} {self.img_shape(self.folder + j)}"
+                          f"\t{final_image_name}{self.extension_out} {self.img_shape(self.cropped[i])}"
+                          f"\tcycles: {self.erasing_info[i].get('Cycles')}"
+                          f"\tengine: {self.erasing_info[i].get('Engine')}\n")
+            if self.failed or self.error_list:
                 log.write(f'\nErrors\n')
-                for w in range(len(skipped_img_index)):
-                    log.write(f'Skipped images: {skipped_img_index[w]}. {self.error_list[w]}\n')
+                for index, failure in self.failed.items():
+                    log.write(f"Quarantined images: {index + 1}. {self.samples[index]}. {failure['Stage']}: "
+                              f"{failure['Error']}\n")
+                for error in self.error_list:
+                    log.write(f'{error}\n')
             log.write(f'\nParameters being used:\n')
             log.write(f'Number of background erasing cycles: {self.cycles}\n')
+            log.write(f'Masks convergence (IoU): {self.convergence}\n')
+            log.write(f"Erasing cycles used in total: {sum(info.get('Cycles') or 0 for info in self.erasing_info)}\n")
+            log.write(f'rembg model: {self.model_name}\n')
+            engine_size = f' ({self.mask_size} px)' if self.engine != 'rembg' else ''
+            log.write(f'Background engine: {self.engine}{engine_size}\n')
+            if self.engine == 'classical':
+                log.write(f'Fallback engine: {self.fallback} for the confidence below {self.min_confidence}\n')
+            log.write(f'Streaming mode: {self.streaming}\n')
+            log.write(f'Resume mode: {self.resume}. Frames resumed: {self.resumed} erased, '
+                      f'{self.resumed_crops} cropped\n')
+            log.write(f'Cache: {self.cache.cache_path if self.cache else None}\n')
+            if self.mask_extension:
+                frame_format = f'{self.extension_out} (quality {self.frame_quality}) + {self.mask_extension}'
+            else:
+                frame_format = self.extension_out + (f' (compression {self.png_compression})'
+                                                     if self.extension_out == '.png' else '')
+            log.write(f'Processed frames: {frame_format}\n')
+            log.write(f"Frame stack: {'Frames.npy' if self.frame_stack else None}\n")
             log.write(f'Did film was created: {self.film}\n')
             if self.film == 'y':
-                img_shape = self.img_shape(self.cropped[0])
-                log.write(f'Ageing video: {self.video_name}\n')
-                log.write(f'Frame rate: {self.frame_rate}\n')
+                img_shape = self.img_shape()
+                for video in self.videos:
+                    log.write(f"Ageing video: {video['Name']}. Codec: {video['Codec']}, frame rate: "
+                              f"{video['Frame rate']}, size (w, h): {video['Size']}\n")
                 if img_shape is not None:
                     frame_size = img_shape[0:2]
                     log.write(f'Frame size: {frame_size}\n')
                 else:
                     log.write('Frame size: Error reading image\n')
+            log.write(f'\nStages (wall time, CPU time, peak RSS):\n')
+            for stage in self.profiler.stages:
+                log.write(f"{stage['Stage']}: \t{stage['Wall time']:.2f} sec, \t{stage['CPU time']:.2f} sec, "
+                          f"\t{stage['Peak RSS MB']:.0f} MB\n")
             log.write(f'\nImages processing time: \t{self.executed_time - self.start_time} sec'
                       f'\nTotal time: \t{time.time() - self.start_time} sec\n')
+        images = [{'Name': sample, **info} for sample, info in zip(self.samples, self.erasing_info)]
+        self.profiler.save(f"{self.path_out}Profile {self.sample_name} {today}.json", Sample=self.sample_name,
+                           Settings=self.settings, Images=images)
 
     def img_shape(self, img=None):
         """
-        Getting dimensions and channels of the first cropped image
+        Getting dimensions and channels of an image, the first cropped one by default. Only the file header is read
         :return: height, width, channels
         """
         if not img:
-            img = self.cropped[0]
-        img_hwc = cv2.imread(img)
-        if img_hwc is not None:
-            height, width, channels = img_hwc.shape
-            return height, width, channels
-        else:
+            img = next(cropped for cropped in self.cropped if cropped)
+        img_hwc = image_size(img)
+        if img_hwc is None:
             print(f"Error reading image at {img}. Skipping this image.")
-            return None
+        return img_hwc
 
-    def create_video(self):
+    def film_writers(self):
         """
-        Create a video based on processed images
-        :return: None
+        Open a writer for every rendition of the ageing video. Each writer encodes on its own thread, so a frame is
+        passed to all of them and encoded into all the renditions at once
+        :return: List of FilmWriter
         """
-        # frame = cv2.imread(cropped)
-        img_shape = self.img_shape()
-        if img_shape is not None:
-            height, width, _ = img_shape
-            video = cv2.VideoWriter(self.path_out + self.video_name, 0, self.frame_rate, (width, height))
+        writers = []
+        paths = set()
+        for rendition in self.renditions:
+            codec = rendition.get('codec', self.codec)
+            frame_rate = rendition.get('frame_rate', self.frame_rate)
+            scale, width = rendition.get('scale', 1), rendition.get('width')
+            name = rendition.get('name')
+            if name is None:  # Name the rendition by its differences from the main film
+                name = ' '.join(([f'{width} px'] if width else [f'x{scale}'] if scale != 1 else [])
+                                + ([f'{frame_rate} fps'] if frame_rate != self.frame_rate else []))
+            path = f'{self.path_out}Ageing {self.sample_name}' + (f' {name}' if name else '')
+            if path + FilmWriter.codecs.get(codec, '') in paths:
+                path += f' {codec}'
+            writer = FilmWriter(path, frame_rate, codec, scale=scale, width=width)
+            paths.add(writer.path)
+            writers.append(writer)
+        return writers
 
-            for shoot in trange(len(self.cropped), desc='Filming', ncols=100, unit='img', colour='red', position=1,
-                                leave=False):
-                try:
-                    img_1 = cv2.imread(self.cropped[shoot])
-                    resized = cv2.resize(img_1, (width, height))
-                    video.write(resized)
-                except cv2.error:
-                    pass
-            video.release()
-        else:
-            pass
+    def close_film(self, writers):
+        """
+        Finalize the ageing videos. A failed video is reported, but it does not fail the processed images
+        :param writers: List of FilmWriter
+        :return: None
+        """
+        self.videos = []
+        for writer in writers:
+            video_name = os.path.basename(writer.path)
+            try:
+                writer.close()
+            except Exception as e:
+                print(f'\nFilming of {video_name} failed: {e!r}')
+                self.error_list.append(f'{video_name}: {e!r}')
+                continue
+            self.videos.append({'Name': video_name, 'Codec': writer.codec, 'Frame rate': writer.frame_rate,
+                                'Size': writer.size})
 
     def crop_images(self):
         """
-        Crop images and save in the new folder
+        Crop images and save in the new folder. If the film is asked, the cropped images are passed to the video
+        encoders of all the renditions straight away, so they are never read back from the disk.
+        In the resume mode the frames cropped before are not cropped again unless the crop extent has changed, e.g. by
+        a new frame. They are only read back for the film and the frame stack
         :return: None
         """
-        pbar2 = tqdm(range(len(self.samples)), desc='Cropping images and saving', unit=' image processing',
-                     ncols=100, colour='green', leave=False, position=1)
-        for pic in pbar2:
-            final_image = self.cropping_an_image(self.sizes_pd, self.center[pic], self.pre_processed[pic])
-            # final_image = pre_processed[pic]
-            if final_image is None:
-                raise ValueError('A very specific bad thing happened.')
-            out_img = create_folder(self.folder, "Processed") + str(pic) + '-' + str(
-                self.time_line.iat[pic, 0]) + self.extension_out
-            self.cropped.append(out_img)
-            try:
-                cv2.imwrite(out_img, final_image)
-            except cv2.error:
-                print(f'cv2 error for {self.samples[pic]}')
-                self.error_list.append(str(pic) + '-' + str(self.time_line.iat[pic, 0]) + self.extension_out)
-            pbar2.set_description(f'Cropping and saving image {pic + 1}')
+        extent = self.crop_extent()
+        recrop = extent != self.manifest['Crop extent']
+        self.manifest['Crop extent'] = extent
+        names = {pic: f'{pic}-{self.time_line.iat[pic, 0]}{self.extension_out}' for pic in self.good_frames()}
+        done = set() if recrop else {pic for pic in names if self.is_cropped(pic, names[pic])}
+        self.resumed_crops = len(done)
+        missing = [pic for pic in names if pic not in done and pic not in self.no_background]
+        if missing:  # The frames restored from the manifest are erased again to be cropped with the new extent
+            with self.profiler.stage('Erasing for cropping'):
+                if self.streaming:
+                    self.streaming_geometry(missing)
+                else:
+                    self.erase_background(missing)
+        good = self.good_frames()
+        writers = self.film_writers() if self.film == 'y' else []
+        pbar2 = tqdm(good, desc='Cropping images and saving', unit=' image processing',
+                     ncols=100, colour='green', leave=False, position=1, disable=not self.progress)
+        stack, stack_frames, saved = None, [], {}
+        image_writer = AsyncImageWriter(self.image_writers, png_compression=self.png_compression,
+                                        webp_quality=self.frame_quality if self.mask_extension else 101,
+                                        jpeg_quality=self.frame_quality)
+        with self.profiler.stage('Cropping'):
+            for pic in pbar2:
+                out_img = self.path_out + names[pic]
+                if pic in done:
+                    final_image = load_frame(out_img) if writers or self.frame_stack else None
+                else:
+                    window = self.cropping_window(self.sizes_pd, self.geometry[pic]['center'])
+                    final_image = self.rotate_and_crop(self.erased_frame(pic), self.geometry[pic], window)
+                    self.no_background.pop(pic, None)  # The erased frame is not needed anymore
+                    if final_image is None:
+                        self.quarantine(pic, 'Cropping', 'The cropping window is out of the picture')
+                        continue
+                    saved[out_img] = pic
+                    if self.mask_extension:
+                        mask_img = os.path.splitext(out_img)[0] + self.mask_extension
+                        saved[mask_img] = pic
+                        image_writer.submit(out_img, final_image[:, :, :3])
+                        image_writer.submit(mask_img, final_image[:, :, 3])
+                    else:
+                        image_writer.submit(out_img, final_image)
+                    self.record_frame(pic, Cropped=names[pic])
+                self.cropped[pic] = out_img
+                if final_image is None:
+                    continue
+                for writer in writers:
+                    writer.write(final_image)
+                if self.frame_stack:
+                    if stack is None:
+                        stack = np.lib.format.open_memmap(self.path_out + 'Frames.npy', mode='w+', dtype=np.uint8,
+                                                          shape=(len(good), *final_image.shape[:2], 4))
+                    stack[len(stack_frames)] = self.stack_frame(final_image, stack.shape[1:3])
+                    stack_frames.append(pic)
+                pbar2.set_description(f'Cropping and saving image {pic + 1}')
+        with self.profiler.stage('Saving'):  # Waiting for the images being saved
+            for out_img, error in image_writer.close():
+                print(f'cv2 error for {os.path.basename(out_img)}: {error!r}')
+                self.error_list.append(os.path.basename(out_img))
+                self.quarantine(saved[out_img], 'Saving', repr(error))
+            if stack is not None:  # Drop the frames failed while cropping or saving and the unused positions
+                kept = []
+                for position, pic in enumerate(stack_frames):
+                    if pic in self.failed:
+                        continue
+                    if position != len(kept):
+                        stack[len(kept)] = stack[position]
+                    kept.append(pic)
+                stack.flush()
+                shape, offset = (len(kept), *stack.shape[1:]), stack.offset
+                del stack
+                self.truncate_stack(self.path_out + 'Frames.npy', offset, shape)
+                self.save_stack_index(shape, kept)
+        with self.profiler.stage('Filming'):  # Waiting for the encoders to finish the queued frames
+            self.close_film(writers)
+
+    def crop_extent(self):
+        """
+        The extent of all the cropping shapes. If it changes, all the frames are cropped again
+        :return: x_min, x_max, y_min, y_max
+        """
+        return [round(float(self.sizes_pd[0].min()), 3), round(float(self.sizes_pd[1].max()), 3),
+                round(float(self.sizes_pd[2].min()), 3), round(float(self.sizes_pd[3].max()), 3)]
+
+    def is_cropped(self, pic, name):
+        """
+        Check if a frame has been cropped by the previous run
+        :param pic: Index of the frame
+        :param name: Name of the cropped image
+        :return: True if the manifest records the cropped image and it exists
+        """
+        out_img = self.path_out + name
+        if self.manifest['Frames'].get(self.samples[pic], {}).get('Cropped') != name or not os.path.isfile(out_img):
+            return False
+        return not self.mask_extension or os.path.isfile(os.path.splitext(out_img)[0] + self.mask_extension)
+
+    @staticmethod
+    def stack_frame(frame, shape):
+        """
+        Prepare a processed frame for the frame stack
+        :param frame: BGR or BGRA frame
+        :param shape: (height, width) of the stack
+        :return: RGBA frame of the given shape
+        """
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGBA if frame.shape[2] == 4 else cv2.COLOR_BGR2RGBA)
+        if frame.shape[:2] != tuple(shape):
+            frame = cv2.resize(frame, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+        return frame
+
+    @staticmethod
+    def truncate_stack(path, offset, shape):
+        """
+        Cut an .npy stack of uint8 to fewer frames. The header is rewritten to the same length, so the data stays in
+        place
+        :param path: Path to the .npy file
+        :param offset: Length of the header, i.e. the offset of the data
+        :param shape: New shape of the stack
+        :return: None
+        """
+        with open(path, 'r+b') as f:
+            preamble = 10 if f.read(7)[6] == 1 else 12  # Magic string, version and the header length of 2 or 4 bytes
+            header = repr({'descr': '|u1', 'fortran_order': False, 'shape': tuple(shape)})
+            f.seek(preamble)
+            f.write(header.ljust(offset - preamble - 1).encode('latin1') + b'\n')
+            f.truncate(offset + math.prod(shape))
+
+    def save_stack_index(self, shape, frames):
+        """
+        Save the index of the frame stack to the 'Frames.json' next to it. The stack is opened with
+        np.load('Frames.npy', mmap_mode='r'), so the frames and their regions are sliced without decoding.
+        The quarantined frames are not in the stack, the index maps the stack positions to the frames
+        :param shape: Shape of the stack
+        :param frames: Indexes of the frames in the stack order
+        :return: None
+        """
+        index = {'Stack': 'Frames.npy', 'Shape': list(shape), 'Channels': 'RGBA',
+                 'Frames': [{'Position': position, 'Frame': pic, 'Hours': int(self.time_line.iat[pic, 0]),
+                             'Name': self.samples[pic], 'File': os.path.basename(self.cropped[pic])}
+                            for position, pic in enumerate(frames)]}
+        with open(self.path_out + 'Frames.json', 'w') as f:
+            json.dump(index, f, indent=4)
 
     @staticmethod
-    def cropping_an_image(shapes, c, image_rotated):  # Final cropping
+    def cropping_window(shapes, c):  # Final cropping
         """
-        Crop preprocessed image
+        Find the cropping window in the coordinates of the rotated image
         :param shapes: Cropping shape
         :param c: Cropping center
-        :param image_rotated: Preprocessed image (rotated if needed)
-        :return: Cropped image
+        :return: x_start, x_end, y_start, y_end of the window
         """
         x_min_0 = shapes[0].min()
         x_max_0 = shapes[1].max()
@@ -181,56 +589,114 @@ class RemoveBackgroundMakeFilm:
         y_min = c[1] - correction_y
         y_max = c[1] + correction_y
         some_space = 0
-        crop_img = image_rotated[round(y_min) - some_space:round(y_max) + some_space,
-                   round(x_min) - some_space:round(x_max) + some_space]
-        # crop_img = image_rotated[round(y_min_0) - some_space:round(y_max_0) + some_space,
-        #            round(x_min_0) - some_space:round(x_max_0) + some_space]
-        return crop_img
+        return (round(x_min) - some_space, round(x_max) + some_space,
+                round(y_min) - some_space, round(y_max) + some_space)
+
+    @staticmethod
+    def rotate_and_crop(photo, geometry, window):
+        """
+        Rotate and crop a picture at once. Only the cropping window is warped: the rotation matrix is shifted to the
+        window origin and the window size is used as the output size, so the rotation stays the same while the rest of
+        the full resolution frame is never warped. The window is clipped to the frame the same way slicing does it
+        :param photo: Picture with erased background
+        :param geometry: Geometry of the picture obtained with an_image_geometry
+        :param window: Cropping window obtained with cropping_window
+        :return: Cropped image or None if the window is out of the picture
+        """
+        height, width = geometry['shape']
+        x_start, x_end, y_start, y_end = window
+        x_start, y_start = max(x_start, 0), max(y_start, 0)
+        x_end, y_end = min(x_end, width), min(y_end, height)
+        if x_end <= x_start or y_end <= y_start:
+            return None
+        matrix = geometry['matrix'].copy()
+        matrix[0, 2] -= x_start
+        matrix[1, 2] -= y_start
+        return cv2.warpAffine(photo, matrix, (x_end - x_start, y_end - y_start))
 
-    def processing_images(self):
+    def processing_images(self, indexes):
         """
-        Preprocess pictures, fill the self.pre_processed, self.sizes, self.center lists
+        Find the geometry of the given pictures, fill the self.geometry list. A picture without a device is quarantined.
+        Pictures are not rotated here, the rotation is applied only to the cropping window, see rotate_and_crop
+        :param indexes: Indexes of the pictures
         :return: None
         """
-        pbar1 = tqdm(range(len(self.samples)), desc='Preprocessing images', unit=' image processing', ncols=100,
-                     colour='YELLOW', position=1, leave=False)
+        pbar1 = tqdm(indexes, desc='Preprocessing images', unit=' image processing', ncols=100,
+                     colour='YELLOW', position=1, leave=False, disable=not self.progress)
         for index in pbar1:
-            image = self.no_background[index]
-            processing = self.an_image_processing(image)[0]
-            if processing is None:
-                raise ValueError('A very specific bad thing happened.')
-            self.pre_processed.append(processing)
-            self.sizes.append(self.set_cropping_shape(self.an_image_processing(image)[1],
-                                                      self.an_image_processing(image)[2]))
-            self.center.append(self.an_image_processing(image)[2])
+            if index in self.failed:
+                continue
+            self.measure_frame(index, self.no_background[index])
             pbar1.set_description(f'Preprocessing image {index + 1}')
 
-    def an_image_processing(self, photo):
+    def measure_frame(self, index, photo):
+        """
+        Find the geometry of a picture and record it. Quarantine the picture if it fails
+        :param index: Index of the picture
+        :param photo: Picture with erased background
+        :return: None
+        """
+        try:
+            self.geometry[index] = self.an_image_geometry(photo)
+        except (ValueError, cv2.error) as e:
+            self.quarantine(index, 'Geometry', repr(e))
+            return
+        self.record_frame(index, Geometry=self.geometry_to_json(self.geometry[index]))
+
+    def an_image_geometry(self, photo):
         """
-        Preprocessing of a single image
-        :param photo: Picture to be preprocessed
-        :return: rotated image, rotation matrix, rotation center
+        Find the geometry of a single image in one pass: the device contour, the rotation matrix, the corners of the
+        device after the rotation and the rotation center.
+        The contour is found on every n-th pixel of the picture, so that the longest side is not above the
+        geometry_size, and the rectangle is scaled back. Only this small picture is converted and searched, so the cost
+        hardly depends on the camera resolution. With refine_geometry the rectangle is found again at full resolution,
+        but only around the device
+        :param photo: Picture with erased background
+        :return: dict with 'matrix', 'corners', 'center' and 'shape' (height, width) of the picture
         """
-        photo0 = cv2.cvtColor(photo, cv2.COLOR_BGR2GRAY)  # If [Start]FindContours supports only CV_8UC1 images when
-        # mode != CV_RETR_FLOODFILL otherwise supports CV_32SC1 images only in function 'cvStartFindContours_Impl'
+        height, width = photo.shape[:2]
+        step = max(1, math.ceil(max(height, width) / self.geometry_size)) if self.geometry_size else 1
+        # If [Start]FindContours supports only CV_8UC1 images when mode != CV_RETR_FLOODFILL otherwise supports
+        # CV_32SC1 images only in function 'cvStartFindContours_Impl'
+        photo0 = cv2.cvtColor(np.ascontiguousarray(photo[::step, ::step]), cv2.COLOR_BGR2GRAY)
         contours_in, _ = cv2.findContours(photo0, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        objects_contours = []
-        for cnt_in in contours_in:
-            area = cv2.contourArea(cnt_in)
-            if area > 100000:
-                objects_contours.append(cnt_in)
-        rect = cv2.minAreaRect(objects_contours[0])
+        min_area = self.min_area_fraction * photo0.shape[0] * photo0.shape[1]
+        objects_contours = [cnt_in for cnt_in in contours_in if cv2.contourArea(cnt_in) > min_area]
+        if not objects_contours:
+            raise ValueError(f'No device contour larger than {self.min_area_fraction:.2%} of the picture')
+        (x, y), (w, h), angle = cv2.minAreaRect(max(objects_contours, key=cv2.contourArea))
+        rect = ((x * step, y * step), (w * step, h * step), angle)
+        if self.refine_geometry and step > 1:
+            rect = self.refine_rect(photo, rect, margin=2 * step)
         (x, y), _, _ = rect
         coord = cv2.boxPoints(rect)
         coord = np.intp(coord)
-        height, width = photo.shape[:2]
         box = self.pick_coordinates(coord)
-        matrix = cv2.getRotationMatrix2D((int(x - 1), int(y - 1)), self.angle_between2(box[-1], box[0]), 1.0)
+        center = (int(x - 1), int(y - 1))
+        matrix = cv2.getRotationMatrix2D(center, self.angle_between2(box[-1], box[0]), 1.0)
         ones = np.ones(shape=(len(coord), 1))
         points_ones = np.hstack([coord, ones])
-        aaa = matrix.dot(points_ones.T).T
-        rotated_image = cv2.warpAffine(photo, matrix, (width, height))
-        return rotated_image, aaa, (int(x - 1), int(y - 1))
+        corners = matrix.dot(points_ones.T).T
+        return {'matrix': matrix, 'corners': corners, 'center': center, 'shape': photo.shape[:2]}
+
+    @staticmethod
+    def refine_rect(photo, rect, margin):
+        """
+        Find the device rectangle at full resolution, looking only at the region around the rough rectangle
+        :param photo: Full resolution picture with erased background
+        :param rect: Rough rectangle scaled up from the downscaled picture
+        :param margin: Margin around the rough rectangle in pixels
+        :return: Refined rectangle, the rough one if nothing is found
+        """
+        box = cv2.boxPoints(rect)
+        x_start, y_start = np.maximum(np.floor(box.min(axis=0) - margin), 0).astype(int)
+        x_end, y_end = np.ceil(box.max(axis=0) + margin).astype(int)
+        region = cv2.cvtColor(np.ascontiguousarray(photo[y_start:y_end, x_start:x_end]), cv2.COLOR_BGR2GRAY)
+        contours, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                       offset=(int(x_start), int(y_start)))
+        if not contours:
+            return rect
+        return cv2.minAreaRect(max(contours, key=cv2.contourArea))
 
     @staticmethod
     def set_cropping_shape(coordinate_matrix, cen):  # Set cropping shape
@@ -275,25 +741,165 @@ class RemoveBackgroundMakeFilm:
         lower_coord = points_sorted[-2:]
         return lower_coord
 
-    def erase_background(self):
-        """
-        Deleting background in all pictures in the given path. If number of cycles more than 1, applying a recursion
-        :return: list with erased background pictures opened in cv2
-        """
-        for cycle in tqdm(range(self.cycles), desc='Erasing cycles', position=1, ncols=100, unit='img',
-                          colour='#FF7518', leave=False):
-            for initial_photo in trange(len(self.samples), desc=f'Cycle {cycle + 1} erasing background', position=2,
-                                        ncols=100, unit='img', leave=False, colour='blue'):
-                if len(self.no_background) == len(self.samples):  # If cycles > 1
-                    clear_img = delete_background(self.no_background[initial_photo])
-                    self.no_background[initial_photo] = clear_img
-                    if clear_img is None:
-                        raise ValueError('A very specific bad thing happened.')
-                if len(self.no_background) < len(self.samples):  # For the first cycle
-                    clear_img = delete_background(self.folder + self.samples[initial_photo])
-                    self.no_background.append(clear_img)
-                    if clear_img is None:
-                        raise ValueError('A very specific bad thing happened.')
+    def erase_background(self, indexes):
+        """
+        Deleting background in the given pictures and keeping them in memory. A failed picture is quarantined
+        :param indexes: Indexes of the pictures
+        :return: None
+        """
+        for index, (clear_img, info, _) in zip(indexes, tqdm(self.erased_frames(indexes), total=len(indexes),
+                                                             desc='Erasing background', position=1, ncols=100,
+                                                             unit='img', colour='#FF7518', leave=False,
+                                                             disable=not self.progress)):
+            self.erasing_info[index] = info
+            if clear_img is None:
+                self.quarantine(index, 'Erasing', info.get('Error'))
+                continue
+            self.no_background[index] = clear_img
+            self.record_frame(index, Erasing=info)
+
+    def erased_frames(self, indexes):
+        """
+        Erase background picture by picture. If the cache is used, only new or changed pictures are erased, the rest
+        are read from the cache
+        :param indexes: Indexes of the pictures
+        :return: Generator of the erased pictures (None for the failed ones), the info about erasing and the path to
+                 the cache entry of the picture (None if it is not cached) in the given order
+        """
+        paths = [self.folder + self.samples[index] for index in indexes]
+        keys = [self.cache.key(path, *self.erasing_settings()) if self.cache else None for path in paths]
+        cached = [key is not None and self.cache.contains(key) for key in keys]
+        fresh = self.erase_pictures([path for path, is_cached in zip(paths, cached) if not is_cached])
+        try:
+            for path, key, is_cached in zip(paths, keys, cached):
+                frame, info = (self.cache.get(key), dict(self.cache.get_info(key), Cached=True)) if is_cached \
+                    else next(fresh)
+                if is_cached and frame is None:  # The entry has been evicted or broken meanwhile
+                    frame, info = next(self.erase_pictures([path]))
+                    is_cached = False
+                if key is not None and not is_cached and frame is not None:
+                    try:
+                        self.cache.put(key, frame, info)
+                    except (OSError, cv2.error) as e:  # The frame is erased anyway, it is only not cached
+                        tqdm.write(f'{os.path.basename(path)} is not cached: {e!r}')
+                    is_cached = self.cache.contains(key)
+                yield frame, info, str(self.cache.entry_path(key)) if is_cached and frame is not None else None
+        finally:
+            fresh.close()
+            if self.cache:
+                self.cache.evict()
+
+    def erasing_settings(self):
+        """
+        Settings the erased pictures depend on. Used to address the cache entries
+        :return: List of settings
+        """
+        settings = [rembg_models.get(self.model_name, self.model_name), self.cycles, self.convergence, self.engine]
+        if self.engine in ('mask', 'classical'):
+            settings.append(self.mask_size)
+        if self.engine == 'classical':
+            settings += [self.fallback, self.min_confidence]
+        return settings
+
+    def erase_pictures(self, paths):
+        """
+        Erase background in the given pictures, running all the cycles for a picture at once. If there are more than
+        one worker, pictures are spread across a pool of processes. Each worker loads its own rembg model once.
+        If the intra-op threads are not specified, the CPU cores are split between the workers to avoid oversubscription
+        :param paths: Paths to the pictures
+        :return: Generator of the erased pictures (None for the failed ones) and the info about erasing in the given
+                 order
+        """
+        if not paths:
+            return
+        erase = partial(delete_background_safely, cycles=self.cycles, convergence=self.convergence, engine=self.engine,
+                        mask_size=self.mask_size, fallback=self.fallback, min_confidence=self.min_confidence)
+        if self.workers > 1 and len(paths) > 1:
+            intra_op_threads = self.intra_op_threads or max(1, (os.cpu_count() or 1) // self.workers)
+            inter_op_threads = self.inter_op_threads or 1
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_background_worker,
+                                           initargs=(self.model_name, intra_op_threads, inter_op_threads))
+            pending = deque()
+            try:
+                for path in paths:  # Submit through a window, so finished pictures do not pile up in memory
+                    pending.append(executor.submit(erase, path))
+                    if len(pending) >= 2 * self.workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                executor.shutdown(cancel_futures=True)  # Do not wait for the rest if the consumer has stopped
+            return
+        session = get_rembg_session(self.model_name, self.intra_op_threads, self.inter_op_threads)
+        for path in paths:
+            yield erase(path, session=session)
+
+    def erased_frame(self, index):
+        """
+        Get an erased picture. In the streaming mode it is read back from the disk. If its cache entry has been
+        evicted meanwhile, the picture is erased again
+        :param index: Index of the picture
+        :return: Erased picture opened in cv2
+        """
+        frame = self.no_background[index]
+        if type(frame) is str:
+            path = frame
+            frame = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if frame is None and self.cache and Path(path).is_relative_to(self.cache.cache_path):
+                frame = next(self.erase_pictures([self.folder + self.samples[index]]))[0]
+        return frame
+
+    def streaming_geometry(self, indexes):
+        """
+        The first pass of the streaming mode. Erase background, find the geometry and put the erased picture aside
+        to the disk one picture at a time, so the memory does not depend on the number of pictures.
+        Fill the self.no_background with paths and the self.geometry list. A failed picture is quarantined.
+        The geometry is saved to the 'Geometry.json' in the output folder
+        :param indexes: Indexes of the pictures
+        :return: None
+        """
+        erased_folder = create_folder(self.path_out, 'Erased')
+        image_writer = AsyncImageWriter(self.image_writers, png_compression=1)
+        for index, (clear_img, info, cache_path) in zip(indexes, tqdm(self.erased_frames(indexes), total=len(indexes),
+                                                                      position=1, ncols=100, unit='img',
+                                                                      desc='Erasing background and finding geometry',
+                                                                      colour='#FF7518', leave=False,
+                                                                      disable=not self.progress)):
+            self.erasing_info[index] = info
+            if clear_img is None:
+                self.quarantine(index, 'Erasing', info.get('Error'))
+                continue
+            self.record_frame(index, Erasing=info)
+            if cache_path:  # Read back from the cache instead of encoding a copy
+                self.no_background[index] = cache_path
+            else:
+                erased_path = f'{erased_folder}{index}.png'
+                image_writer.submit(erased_path, clear_img)
+                self.no_background[index] = erased_path
+            self.measure_frame(index, clear_img)
+        for erased_path, error in image_writer.close():  # The erased pictures are read back by cropping
+            self.quarantine(int(Path(erased_path).stem), 'Erasing', repr(error))
+        self.save_geometry()
+
+    def save_geometry(self):
+        """
+        Save the geometry of all pictures to the 'Geometry.json' in the output folder
+        :return: None
+        """
+        geometry = [{'Name': sample, **self.geometry_to_json(g)}
+                    for sample, g in zip(self.samples, self.geometry) if g is not None]
+        with open(self.path_out + 'Geometry.json', 'w') as f:
+            json.dump(geometry, f, indent=4)
+
+    @staticmethod
+    def geometry_to_json(geometry):
+        return {'Center': list(geometry['center']), 'Shape': list(geometry['shape']),
+                'Matrix': geometry['matrix'].tolist(), 'Corners': geometry['corners'].tolist()}
+
+    @staticmethod
+    def geometry_from_json(geometry):
+        return {'matrix': np.array(geometry['Matrix']), 'corners': np.array(geometry['Corners']),
+                'center': tuple(geometry['Center']), 'shape': tuple(geometry['Shape'])}
 
     def timeline_detector(self):
         """
@@ -338,18 +944,19 @@ class RemoveBackgroundMakeFilm:
         :param path: the path to a folder
         :return: list with folder(s) containing pictures with the specified extension
         """
-        # target_folders = [
+        # self.target_folders = [
         #     "77_0", "78_0", "79_0", "79_1", "80_0", "80_1", "82_0", "83_0", "85_0", "85_1",
         #     "86_0", "87_0", "90_0", "91_1", "132_0", "138_1", "141_0", "157_1"
         # ]
-        # target_folders = ['R3_0']
-        target_folders = []
+        # self.target_folders = ['R3_0']
+        target_folders = self.target_folders
         folders = []
         for dir_path, dir_names, files in os.walk(path):
             for file in files:
                 if file.endswith(self.extension):
                     if target_folders:
-                        if dir_path not in folders and os.path.basename(dir_path) in target_folders:
+                        if dir_path not in folders and (os.path.basename(dir_path) in target_folders
+                                                        or dir_path in target_folders):
                             folders.append(dir_path)
                     else:
                         if dir_path not in folders:
@@ -363,6 +970,79 @@ class RemoveBackgroundMakeFilm:
         return folders
 
 
+def process_folder_job(settings, folder):
+    """
+    Process a single sample folder in a separate process, see RemoveBackgroundMakeFilm.process_folders_parallel
+    :param settings: Settings of RemoveBackgroundMakeFilm
+    :param folder: Path to the folder
+    :return: dict with the summary of the folder
+    """
+    film_maker = RemoveBackgroundMakeFilm(**dict(settings, target_folders=[folder]))
+    return film_maker.run_summary[0]
+
+
+def folder_snapshot(parent_path, extension='.jpg'):
+    """
+    State of the source pictures and the timelines under a parent folder. The output folders are not looked into
+    :param parent_path: Path to the parent folder
+    :param extension: Extension of the source pictures
+    :return: dict with path - (modification time, size)
+    """
+    snapshot = {}
+    for dir_path, dir_names, files in os.walk(parent_path):
+        dir_names[:] = [name for name in dir_names if name not in ('Processed', 'RGB_analyzing')]
+        for file in files:
+            if file.endswith(extension) or file == 'Timeline.json':
+                path = os.path.join(dir_path, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # Deleted meanwhile
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def watch_folder(parent_path, interval=60, debounce=300, runs=None, **settings):
+    """
+    Watch a parent folder and process the sample folders as new pictures arrive. The folder is polled, and the changed
+    sample folders are processed once no picture has changed for the debounce time, so the pictures being copied are
+    not taken. The processing resumes from the manifests and uses the cache, so only the new frames are erased and
+    the processed sequence, the film and the log are updated. A changed timeline makes all the folders processed
+    :param parent_path: Path to the parent folder
+    :param interval: Seconds between the checks
+    :param debounce: Seconds the pictures must stay unchanged before processing
+    :param runs: Stop after this number of processing runs. None watches until interrupted with Ctrl+C
+    :param settings: Settings of RemoveBackgroundMakeFilm. The resume mode and the cache are always on
+    :return: None
+    """
+    if not parent_path.endswith('/'):
+        parent_path = parent_path + '/'
+    settings = dict(settings, resume=True, cache=True)
+    processed, previous, last_change, runs_done = {}, None, time.time(), 0
+    print(f'Watching {parent_path}. Press Ctrl+C to stop')
+    try:
+        while runs is None or runs_done < runs:
+            current = folder_snapshot(parent_path)
+            if current != previous:
+                previous, last_change = current, time.time()
+            changed = {path for path in current.keys() | processed.keys() if current.get(path) != processed.get(path)}
+            if changed and time.time() - last_change >= debounce:
+                folders = sorted({os.path.dirname(path) for path in changed if os.path.isdir(os.path.dirname(path))})
+                if any(os.path.basename(path) == 'Timeline.json' for path in changed) or \
+                        os.path.normpath(parent_path) in folders:
+                    folders = None  # All the folders
+                if folders != []:  # Not only deleted folders
+                    print(f'\n{datetime.now():%Y-%m-%d %H:%M:%S} processing {len(folders) if folders else "all"} '
+                          f'folder(s)')
+                    RemoveBackgroundMakeFilm(parent_path, **dict(settings, target_folders=folders))
+                processed = current
+                runs_done += 1
+                continue
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print('Watching stopped')
+
+
 if __name__ == '__main__':
     start_time = time.time()
     path_to = r'C:\Users\runiza_admin\OneDrive - O365 Turun yliopisto\Desktop\new_aging_blah_blah/'
@@ -0,0 +1,165 @@
+import queue
+import shutil
+import subprocess
+import threading
+
+import cv2
+from PIL import Image
+
+
+class FilmWriter:
+    codecs = {'MJPG': '.avi', 'FFV1': '.avi', 'H264': '.mp4', 'RAW': '.avi', 'GIF': '.gif', 'WEBP': '.webp'}
+    animations = ('GIF', 'WEBP')
+
+    def __init__(self, path, frame_rate=1, codec='MJPG', size=None, scale=1, width=None, queue_size=8):
+        """
+        Video writer receiving frames in memory and encoding them on a background thread, so encoding overlaps with
+        processing of the next frames.
+
+        Codecs:
+        - 'MJPG': Motion JPEG, compact and readable everywhere.
+        - 'H264': H.264 through an ffmpeg pipe, the most compact one. Falls back to 'MJPG' if ffmpeg is not found.
+        - 'FFV1': Lossless FFV1.
+        - 'RAW': Uncompressed frames.
+        - 'GIF', 'WEBP': Animated pictures made with PIL for previews. PIL keeps all their frames in memory, so use
+          them with a small scale or width.
+
+        :param path: Path to the video without extension, the extension is chosen by the codec
+        :param frame_rate: Frame rate of the video
+        :param codec: 'MJPG', 'H264', 'FFV1' or 'RAW'
+        :param size: (width, height) of the video. If None, the size of the first frame is used. Frames of other sizes
+                     are resized
+        :param scale: Scale of the first frame to get the size of the video if the size is not given
+        :param width: Width of the video if the size is not given. The height keeps the aspect ratio of the first frame
+        :param queue_size: Number of frames waiting for encoding. A producer waits if the queue is full
+        """
+        if codec not in self.codecs:
+            raise ValueError(f'Unknown codec {codec}. Choose one of {list(self.codecs)}')
+        if codec == 'H264' and shutil.which('ffmpeg') is None:
+            print('ffmpeg is not found, MJPG is used instead of H264')
+            codec = 'MJPG'
+        self.codec = codec
+        self.path = path + self.codecs[codec]
+        self.frame_rate = frame_rate
+        self.size = size
+        self.scale = scale
+        self.width = width
+        self.frames_written = 0
+        self.finished = False
+        self.error = None
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.encoding, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, frame):
+        """
+        Queue a frame for encoding
+        :param frame: BGR or BGRA frame opened in cv2
+        :return: None
+        """
+        self.frames.put(frame)
+
+    def close(self):
+        """
+        Encode the queued frames and finalize the video
+        :return: None
+        """
+        self.frames.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def encoding(self):
+        """
+        Encode frames from the queue until None is received. If encoding fails, the rest of the frames are dropped and
+        the error is raised by close
+        :return: None
+        """
+        writer = None
+        try:
+            if self.codec in self.animations:
+                self.save_animation(self.queued_frames())
+                return
+            for frame in self.queued_frames():
+                if writer is None:
+                    writer = self.open_writer()
+                if self.codec == 'H264':
+                    writer.stdin.write(frame.tobytes())
+                else:
+                    writer.write(frame)
+        except Exception as e:
+            self.error = e
+            while not self.finished and self.frames.get() is not None:  # Do not block the producer
+                pass
+        finally:
+            if self.codec == 'H264' and writer is not None:
+                try:
+                    writer.stdin.close()
+                except BrokenPipeError:  # ffmpeg has exited already, its exit code tells why
+                    pass
+                if writer.wait() != 0 and (self.error is None or isinstance(self.error, BrokenPipeError)):
+                    self.error = IOError(f'ffmpeg failed with exit code {writer.returncode} for {self.path}')
+            elif writer is not None:
+                writer.release()
+
+    def queued_frames(self):
+        """
+        Take frames from the queue until None is received
+        :return: Generator of frames prepared for encoding
+        """
+        while (frame := self.frames.get()) is not None:
+            yield self.prepare_frame(frame)
+            self.frames_written += 1
+        self.finished = True
+
+    def prepare_frame(self, frame):
+        """
+        Convert a frame to BGR of the video size
+        :param frame: BGR or BGRA frame
+        :return: BGR frame
+        """
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        if self.size is None:
+            height, width = frame.shape[:2]
+            scale = self.width / width if self.width else self.scale
+            self.size = max(1, round(width * scale)), max(1, round(height * scale))
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def save_animation(self, frames):
+        """
+        Save frames as an animated GIF or WebP
+        :param frames: Iterable of BGR frames
+        :return: None
+        """
+        images = (Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for frame in frames)
+        first = next(images, None)
+        if first is None:
+            return
+        first.save(self.path, save_all=True, append_images=images, duration=round(1000 / self.frame_rate), loop=0)
+
+    def open_writer(self):
+        """
+        Open a cv2.VideoWriter or an ffmpeg process for the H264
+        :return: Writer
+        """
+        width, height = self.size
+        if self.codec == 'H264':
+            command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                       '-s', f'{width}x{height}', '-r', str(self.frame_rate), '-i', '-',
+                       '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                       '-crf', '18', self.path]
+            return subprocess.Popen(command, stdin=subprocess.PIPE)
+        fourcc = 0 if self.codec == 'RAW' else cv2.VideoWriter_fourcc(*self.codec)
+        writer = cv2.VideoWriter(self.path, fourcc, self.frame_rate, (width, height))
+        if not writer.isOpened():
+            raise IOError(f'Cannot open a video writer for {self.path} with the {self.codec} codec')
+        return writer
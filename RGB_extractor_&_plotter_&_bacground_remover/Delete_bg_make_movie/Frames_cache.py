@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import cv2
+
+
+class ErasedFramesCache:
+    default_path = Path.home() / '.cache' / 'Erased_frames'
+
+    def __init__(self, cache_path=None, max_size_gb=30):
+        """
+        On-disk cache of pictures with erased background. An entry is addressed by the hash of the source file and the
+        erasing settings (rembg model, number of cycles, etc.), so a changed picture or changed settings never hit an
+        old entry. When the cache grows over the limit, the least recently used entries are evicted.
+
+        :param cache_path: Folder to keep the cache in. Default is '~/.cache/Erased_frames'
+        :param max_size_gb: Size limit of the cache in GB
+        """
+        self.cache_path = Path(cache_path) if cache_path else self.default_path
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+
+    @staticmethod
+    def file_hash(path, chunk_size=1024 ** 2):
+        """
+        Hash the content of a file
+        :param path: Path to the file
+        :param chunk_size: Size of the chunks the file is read by
+        :return: SHA-256 hex digest
+        """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def key(self, path, *settings):
+        """
+        Generate a key of an entry
+        :param path: Path to the source picture
+        :param settings: Erasing settings the result depends on, e.g. the rembg model name and the number of cycles
+        :return: Key of the entry
+        """
+        return '_'.join([self.file_hash(path)] + [str(setting) for setting in settings])
+
+    def entry_path(self, key):
+        """
+        Get the path of an entry. Entries are spread across subfolders named by the first hash characters
+        :param key: Key of the entry
+        :return: Path to the entry
+        """
+        return self.cache_path / key[:2] / f'{key}.png'
+
+    def contains(self, key):
+        return self.entry_path(key).is_file()
+
+    def get(self, key):
+        """
+        Read an entry and mark it as recently used
+        :param key: Key of the entry
+        :return: Picture opened in cv2 or None if there is no such entry
+        """
+        entry = self.entry_path(key)
+        if not entry.is_file():
+            return None
+        img = cv2.imread(str(entry), cv2.IMREAD_UNCHANGED)
+        if img is not None:
+            try:
+                os.utime(entry)  # The modification time is used as the last access time by the LRU eviction
+            except FileNotFoundError:  # Evicted by another process meanwhile, the picture is read already
+                pass
+        return img
+
+    def get_info(self, key):
+        """
+        Read the info stored along with an entry
+        :param key: Key of the entry
+        :return: dict with the info, empty if there is no info
+        """
+        info_path = self.entry_path(key).with_suffix('.json')
+        try:
+            with open(info_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:  # No info, or evicted by another process meanwhile
+            return {}
+        except ValueError:  # Broken info, e.g. written by an older version without the temporary file
+            return {}
+
+    def put(self, key, img, info=None):
+        """
+        Write an entry. The picture and the info are written to temporary files of the process first, so an
+        interrupted run never leaves a broken entry behind and the processes sharing the cache never read or move
+        the files another one is writing
+        :param key: Key of the entry
+        :param img: Picture opened in cv2
+        :param info: dict with info about erasing to store along with the picture, e.g. the number of cycles used
+        :return: None
+        """
+        entry = self.entry_path(key)
+        entry.parent.mkdir(exist_ok=True)
+        if info:
+            temp_info = entry.with_name(f'{key}.{os.getpid()}.tmp.json')
+            with open(temp_info, 'w') as f:
+                json.dump(info, f)
+            os.replace(temp_info, entry.with_suffix('.json'))
+        temp_entry = entry.with_name(f'{key}.{os.getpid()}.tmp.png')
+        if cv2.imwrite(str(temp_entry), img, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+            os.replace(temp_entry, entry)
+        else:
+            temp_entry.unlink(missing_ok=True)
+
+    def entries(self):
+        """
+        List all entries. Entries deleted meanwhile by another process sharing the cache are skipped
+        :return: List of (path, size in bytes, last access time) sorted from the least recently used
+        """
+        entries = []
+        for entry in self.cache_path.glob('*/*.png'):
+            if entry.name.endswith('.tmp.png'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[-1])
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, max_size=None):
+        """
+        Delete the least recently used entries until the cache fits the size limit
+        :param max_size: Size limit in bytes. Default is the one of the cache
+        :return: Number of deleted entries
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        deleted = 0
+        for entry, size, _ in entries:
+            if total <= max_size:
+                break
+            entry.unlink(missing_ok=True)
+            entry.with_suffix('.json').unlink(missing_ok=True)
+            total -= size
+            deleted += 1
+        return deleted
+
+    def clear(self):
+        return self.evict(max_size=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or prune the cache of pictures with erased background')
+    parser.add_argument('command', choices=['info', 'prune', 'clear'])
+    parser.add_argument('--path', default=None, help=f'Cache folder. Default is {ErasedFramesCache.default_path}')
+    parser.add_argument('--max-size-gb', type=float, default=30, help='Size limit used by "prune"')
+    args = parser.parse_args()
+    cache = ErasedFramesCache(args.path, args.max_size_gb)
+    if args.command == 'info':
+        all_entries = cache.entries()
+        print(f'Cache: {cache.cache_path}')
+        print(f'Entries: {len(all_entries)}')
+        print(f'Size: {sum(e[1] for e in all_entries) / 1024 ** 3:.2f} GB of {args.max_size_gb} GB')
+    elif args.command == 'prune':
+        print(f'Deleted {cache.evict()} entries')
+    elif args.command == 'clear':
+        print(f'Deleted {cache.clear()} entries')
@@ -0,0 +1,82 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from Instruments import save_packed_mask
+
+
+class AsyncImageWriter:
+    def __init__(self, workers=4, max_pending=None, png_compression=1, webp_quality=101, jpeg_quality=95):
+        """
+        Save images on a pool of threads, so encoding of an image overlaps with processing of the next ones.
+        cv2 releases the GIL while encoding, so the threads run in parallel. The number of images waiting for saving is
+        bounded, so a fast producer waits instead of piling up frames in memory.
+
+        :param workers: Number of threads
+        :param max_pending: Number of images submitted but not saved yet. Default is twice the number of threads
+        :param png_compression: PNG compression level from 0 (the fastest, the largest files) to 9
+        :param webp_quality: WebP quality from 1 to 100, above 100 is lossless
+        :param jpeg_quality: JPEG quality from 0 to 100
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Image_writer')
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self.params = {'.png': [cv2.IMWRITE_PNG_COMPRESSION, png_compression],
+                       '.webp': [cv2.IMWRITE_WEBP_QUALITY, webp_quality],
+                       '.jpg': [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]}
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, path, img):
+        """
+        Queue an image for saving. Waits if there are too many images pending. The image must not be changed afterwards
+        :param path: Path to save the image to. The format is chosen by the extension, '.npz' saves a 1-bit mask
+        :param img: Image opened in cv2
+        :return: Future of the saving
+        """
+        params = self.params.get(os.path.splitext(path)[1].lower(), [])
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.write, path, img, params)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append((path, future))
+        return future
+
+    @staticmethod
+    def write(path, img, params):
+        if path.endswith('.npz'):
+            save_packed_mask(path, img)
+        elif not cv2.imwrite(path, img, params):
+            raise IOError(f'Cannot write {path}')
+
+    def flush(self):
+        """
+        Wait until all the submitted images are saved
+        :return: List of (path, error) of the images failed to be saved
+        """
+        errors = []
+        for path, future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append((path, e))
+        self.futures = []
+        return errors
+
+    def close(self):
+        """
+        Save the rest of the images and stop the threads
+        :return: List of (path, error) of the images failed to be saved
+        """
+        errors = self.flush()
+        self.executor.shutdown()
+        return errors
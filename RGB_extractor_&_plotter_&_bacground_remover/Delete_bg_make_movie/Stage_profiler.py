@@ -0,0 +1,97 @@
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class StageProfiler:
+    def __init__(self, sample_interval=0.1):
+        """
+        Record wall time, CPU time and peak memory of the pipeline stages.
+        CPU time includes the finished child processes, e.g. the erasing workers, where the platform reports it.
+        With psutil the peak RSS of a stage is sampled for the process and all its children during the stage.
+        Without psutil it is the peak RSS of the process reached so far
+        :param sample_interval: Interval of the RSS sampling in seconds
+        """
+        self.sample_interval = sample_interval
+        self.stages = []
+        self.process = psutil.Process() if psutil else None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Profile a stage: with profiler.stage('Cropping'): ...
+        :param name: Name of the stage
+        :return: None
+        """
+        start_wall, start_cpu = time.perf_counter(), self.cpu_time()
+        peak = [self.rss()]
+        stop = threading.Event()
+
+        def sampling():
+            while not stop.wait(self.sample_interval):
+                peak[0] = max(peak[0], self.rss())
+
+        sampler = threading.Thread(target=sampling, daemon=True) if self.process else None
+        if sampler:
+            sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            if sampler:
+                sampler.join()
+            peak[0] = max(peak[0], self.rss())
+            self.stages.append({'Stage': name, 'Wall time': time.perf_counter() - start_wall,
+                                'CPU time': self.cpu_time() - start_cpu, 'Peak RSS MB': peak[0] / 1024 ** 2})
+
+    @staticmethod
+    def cpu_time():
+        """
+        CPU time of the process and its finished children
+        :return: Seconds
+        """
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def rss(self):
+        """
+        Current RSS of the process and its children, or the peak RSS so far if psutil is not installed
+        :return: Bytes
+        """
+        if self.process:
+            total = 0
+            for process in [self.process] + self.process.children(recursive=True):
+                try:
+                    total += process.memory_info().rss
+                except psutil.Error:  # The child has finished meanwhile
+                    pass
+            return total
+        if resource:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if platform.system() == 'Darwin' else peak * 1024  # Linux reports KB, macOS bytes
+        return 0
+
+    def save(self, path, **extra):
+        """
+        Save the stages to a json file
+        :param path: Path to the json file
+        :param extra: Additional data to save, e.g. the per-image timings and the settings
+        :return: None
+        """
+        profile = {'Machine': {'Platform': platform.platform(), 'Processor': platform.processor(),
+                               'CPU count': os.cpu_count(), 'psutil': psutil is not None},
+                   'Stages': self.stages, **extra}
+        with open(path, 'w') as f:
+            json.dump(profile, f, indent=4, default=str)
@@ -1,26 +1,35 @@
 import json
 import os
+import queue
 import time
 import tkinter as tk
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from idlelib.tooltip import Hovertip
 from pathlib import Path
 from tkinter import filedialog, ttk, messagebox
 
 import customtkinter as ctk
-from PIL import Image, ImageTk
-from natsort import natsorted
 from tqdm import tqdm
 
-from Instruments import get_screen_settings
+from Directory_scanner import DirectoryScanner
+from Image_provider import ImageProvider
+from Instruments import get_screen_settings, image_size, is_mask_file
+from Preview_cache import PreviewCache
 from RGB_select_areas import RGBExtractingCanvas
 
 
 class RGBMainRoot(ctk.CTk):
     screen_width, screen_height = 700, 680
 
-    def __init__(self, zoom=2, *args, **kwargs):
+    def __init__(self, zoom=2, area_tables=False, preview_cache=True, *args, **kwargs):
+        """
+        :param zoom: Zoom of the shown pictures
+        :param area_tables: Show the average RGB of an area live while drawing it, using summed-area tables
+        :param preview_cache: Keep the previews in '~/.cache/RGB_previews.sqlite', so the same pictures open instantly
+                              in the next sessions
+        """
         super().__init__(*args, **kwargs)
         self.s = ttk.Style()
         self.s.configure('Treeview', rowheight=30)
@@ -30,20 +39,22 @@ class RGBMainRoot(ctk.CTk):
         self.zi = zoom  # Zoom. For FullHD screens 4 is fine (when working with 6000x4000 pictures). For 4k: 2
         self.zoom_rate = 1 / self.zi
         self.save_after = False
+        self.area_tables = area_tables
+        self.preview_cache = PreviewCache() if preview_cache else None
         # window
         self.title("Average RGB value extractor.py")
         self.geometry(f"{self.screen_width}x{self.screen_height}")
         self.minsize(600, 600)
         self.resizable(True, True)
 
-        SpecifyPath(self, self.zoom_rate, self.get_data)
+        SpecifyPath(self, self.zoom_rate, self.get_data, preview_cache=self.preview_cache)
 
     def get_data(self, highest_path, data=None, extension=None, new_zoom=None, first_img=0):
         """
         Pass a data_dict from one Tkinter clss to another one
         :param highest_path: The highest folder path of the project
         :param extension: Images extension
-        :param data: Dict with data
+        :param data: Dict of folders with sequences of images, e.g. ImageProvider
         :param new_zoom: If desired zoom might be changed
         :param first_img: If desired first image to shown might be changed
         :return: None
@@ -55,13 +66,18 @@ class RGBMainRoot(ctk.CTk):
         total_data_dict = {}
         for i, (key, value) in enumerate(self.data.items()):
             temp_rgb_executor = RGBExtractingCanvas(self, folder=key, data=value, zoom=zoom, extension=extension,
-                                                    current_folder=i + 1, data_len=len(self.data), start_from=first_img)
+                                                    current_folder=i + 1, data_len=len(self.data), start_from=first_img,
+                                                    area_tables=self.area_tables)
             all_instances.append(temp_rgb_executor)
             total_data_dict[key] = temp_rgb_executor.get_data_dict()
         temp_rgb_executor.destroy()
         for instance in tqdm(all_instances, desc=f'Saving images with rectangles', ncols=100, unit='directory',
                              colour='#ffc25c', position=0, leave=True):
             instance.save_image_with_areas_after()
+        for provider in self.data.values():
+            provider.close()
+        if self.preview_cache:
+            self.preview_cache.close()
         # Write the total data to a JSON file
         today = f'{datetime.now():%Y-%m-%d %H.%M.%S%z}'
         resulting_json = os.path.join(highest_path, today + ' Total_RGB.json')
@@ -71,11 +87,12 @@ class RGBMainRoot(ctk.CTk):
 
 
 class SpecifyPath(ctk.CTkFrame):
-    def __init__(self, parent, zoom_rate, get_data, *args, **kwargs):
+    def __init__(self, parent, zoom_rate, get_data, preview_cache=None, *args, **kwargs):
         super().__init__(master=parent, *args, **kwargs)
 
         # Some variables
         self.parent = parent
+        self.preview_cache = preview_cache
         self.zoom_rate = zoom_rate
         self.table_size = 15
         if self.zoom_rate == 1 / 4:
@@ -84,8 +101,16 @@ class SpecifyPath(ctk.CTkFrame):
         self.file_directory = '/'
         self.files_selected = []
         self.get_data = get_data
-        self.data = defaultdict(dict)
+        self.data = defaultdict(list)
         self.nodes = {}
+        self.scans = {}
+        self.scan_generation = 0
+        self.scan_position = 0
+        self.pending_rows = None
+        self.scanning = False
+        self.dimensions = queue.Queue()
+        self.dimension_requests = set()
+        self.metadata_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Image_metadata')
         self.new_data = {}
         self.first_img = 0
 
@@ -144,26 +169,14 @@ class SpecifyPath(ctk.CTkFrame):
         """
         ctk.set_appearance_mode(new_appearance_mode)
 
-    def resize_image(self, img):
-        """
-        Resizing an image based on the specified zoom rate
-        :param img: Numeric order of an image
-        :return: Resized image to show with Tkinter
-        """
-        image = Image.open(img)
-        height = image.height * self.zoom_rate
-        width = image.width * self.zoom_rate
-        img_resize = image.resize((int(width), int(height)), resample=Image.Resampling.NEAREST,
-                                  reducing_gap=None)  # Use filter NEAREST to increase performance
-        img_result = ImageTk.PhotoImage(img_resize)
-        return img_result
-
     def final_output(self, state):
         """
         Choose the state to work on
         :param state: Selected files or all the files
         :return: None
         """
+        if self.scanning:  # The table is not complete yet
+            return
         self.data.clear()
         self.files_selected = []
         if state == "Selected":
@@ -200,6 +213,8 @@ class SpecifyPath(ctk.CTkFrame):
         self.table_frame.table.item(item, open=expand_collapse)
         if expand_collapse and select:
             self.table_frame.table.selection_add(item)
+        elif expand_collapse:
+            self.folder_opened(item)
         # Select all nested (children) items
         if self.table_frame.table.get_children(item):
             for item_inner in self.table_frame.table.get_children(item):
@@ -220,8 +235,7 @@ class SpecifyPath(ctk.CTkFrame):
         :return: String with a path
         """
         self.file_directory = filedialog.askdirectory(mustexist=True)
-        self.list_files()
-        self.label_1.configure(text=self.file_directory)
+        self.list_files(rescan=True)  # Shows the directory in the label
 
     def set_extension(self, event):
         """
@@ -234,85 +248,176 @@ class SpecifyPath(ctk.CTkFrame):
             return
         self.list_files()
 
-    def list_files(self):
+    def list_files(self, rescan=False):
         """
-        Update and fill the file table with filtered files
+        Update and fill the file table with filtered files. The directory is scanned on a background thread and the
+        table is filled in batches as the folders are scanned. The scan is kept, so changing the extension does not
+        scan the directory again
+        :param rescan: Scan the directory again even if it has been scanned
+        :return: None
         """
         # Clean the treeview before filling
         for i in self.table_frame.table.get_children():
             self.table_frame.table.delete(i)
         abspath = os.path.abspath(self.file_directory).replace('\\', '/')
         root_node = self.table_frame.table.insert('', 'end', text=os.path.basename(abspath), open=True)
-        self.process_directory(root_node, abspath)
+        self.nodes = {abspath: root_node}
+        scanner = self.scans.get(abspath)
+        if rescan or scanner is None:
+            if scanner is not None:
+                scanner.cancel()
+            scanner = self.scans[abspath] = DirectoryScanner(abspath)
+        self.scan_generation += 1
+        self.scan_position = 0
+        self.pending_rows = None
+        self.set_scanning(True)
+        self.insert_scanned(scanner, self.scan_generation)
+
+    def insert_scanned(self, scanner, generation):
+        """
+        Insert the scanned entries to the table for a short time and reschedule itself until the scan is finished,
+        so the GUI stays responsive
+        :param scanner: DirectoryScanner
+        :param generation: Number of the table filling. Stops if the table is being filled again
+        :return: None
+        """
+        if generation != self.scan_generation:
+            return
+        visible_files = []
+        deadline = time.perf_counter() + 0.02
+        while time.perf_counter() < deadline:
+            if self.pending_rows is None:
+                if self.scan_position < len(scanner.entries):
+                    entry = scanner.entries[self.scan_position]
+                    self.scan_position += 1
+                    self.pending_rows = self.process_directory(scanner.path, [entry])
+                elif scanner.finished.is_set():
+                    self.request_dimensions(visible_files)
+                    self.set_scanning(False)
+                    return
+                else:
+                    break
+            row = next(self.pending_rows, None)
+            if row is None:
+                self.pending_rows = None
+                continue
+            kind, parent, name, path, size = row
+            if kind == 'error':
+                messagebox.showerror('Waring!', f"Too many sub folders in a folder {path}")
+            elif kind == 'file':
+                self.nodes[path] = self.table_frame.table.insert(
+                    parent=self.nodes[parent], index=tk.END, text=name, tags='file',
+                    values=['', str(round(size / 1048576, 2)) + ' MB', path])
+                if self.table_frame.table.item(self.nodes[parent], 'open'):
+                    visible_files.append(self.nodes[path])
+            else:
+                self.nodes[path] = self.table_frame.table.insert(self.nodes[parent], 'end', text=name, open=False,
+                                                                 tags='folder', values=['', '', path])
+        self.request_dimensions(visible_files)
+        self.after(20, self.insert_scanned, scanner, generation)
+
+    def set_scanning(self, scanning):
+        """
+        Disable the proceed buttons while the table is being filled, so only a complete table is proceeded with
+        :param scanning: True if the table is being filled
+        :return: None
+        """
+        self.scanning = scanning
+        state = 'disabled' if scanning else 'normal'
+        self.frame.button_selected.configure(state=state)
+        self.frame.button_all.configure(state=state)
+        self.label_1.configure(text=f'{self.file_directory} (scanning...)' if scanning else self.file_directory)
 
-    def process_directory(self, parent, path, depth=1):
+    def process_directory(self, path, entries, depth=0):
         """
-        Insert to a table and into the file_list filtered by extension type of files, including nested folders.
+        Filter scanned entries by extension type of files, including nested folders.
         Will show folders only if it contains required file.
-        :param parent: parent folder
-        :param path: path to work with
+        :param path: path of the folder the entries are in
+        :param entries: Entries scanned by DirectoryScanner
         :param depth: depth of the folders path
+        :return: Generator of the table rows (kind, parent path, name, path, size)
+        """
+        for entry in entries:
+            if not isinstance(entry, dict):
+                name, abspath, size = entry
+                if name.endswith(self.extension) and not is_mask_file(name):  # Insert a file if extension(s) suits
+                    yield 'file', path, name, abspath, size
+            elif DirectoryScanner.has_files(entry, self.extension, is_mask_file):  # Insert a folder only if
+                # extension(s) suits
+                if entry['Name'].endswith('RGB_analyzing'):
+                    continue
+                elif depth == 1 and not entry['Name'].endswith('Processed'):  # Nested folders with the deep of 1 only
+                    # allowed for the Processed folders
+                    yield 'error', path, entry['Name'], entry['Path'], None
+                    return
+                yield 'folder', path, entry['Name'], entry['Path'], None
+                yield from self.process_directory(entry['Path'], entry['Entries'], depth + 1)
+
+    def request_dimensions(self, items):
+        """
+        Read the dimensions of the images on a background thread, only from the file headers.
+        Called for the files of the opened folders only
+        :param items: Table items of the files
         :return: None
         """
+        items = [item for item in items if item not in self.dimension_requests]
+        if not items:
+            return
+        self.dimension_requests.update(items)
+        paths = [self.table_frame.table.item(item)['values'][-1] for item in items]
+        self.metadata_executor.submit(self.read_dimensions, self.scan_generation, list(zip(items, paths)))
+        self.after(50, self.apply_dimensions)
+
+    def read_dimensions(self, generation, files):
+        for item, path in files:
+            size = image_size(path)
+            self.dimensions.put((generation, item, f'{size[1]}x{size[0]}' if size else ''))
 
-        for file in natsorted(os.listdir(path)):
-            abspath = os.path.join(path, file).replace('\\', '/')
-            b = path.replace(self.file_directory, '').count('/')
-            if os.path.isfile(abspath):
-                if file.endswith(self.extension):  # Insert a file only if extension(s) suits
-                    with Image.open(abspath) as img:
-                        width, height = img.size
-                    size = str(round(os.path.getsize(abspath) / 1048576, 2)) + ' MB'
-                    data = [f'{width}x{height}', size, abspath]
-                    self.table_frame.table.insert(parent=parent, index=tk.END, text=file, values=data, tags='file')
-            if os.path.isdir(abspath):
-                extension_flag = False
-                for dir_path, dir_names, files in os.walk(abspath):
-                    for filename in files:
-                        f_name = os.path.join(dir_path, filename)
-                        if f_name.endswith(self.extension):
-                            extension_flag = True
-                if extension_flag:  # Insert a folder only if extension(s) suits
-                    if abspath.endswith('RGB_analyzing'):
-                        return
-                    elif b == depth and not abspath.endswith('Processed'):  # Nested folders with the deep of 1 only
-                        # allowed for the Processed folders
-                        return messagebox.showerror('Waring!', f"Too many sub folders in"
-                                                               f" a folder {abspath}")
-                    oid = self.table_frame.table.insert(parent, 'end', text=file, open=False, tags='folder',
-                                                        values=['', '', abspath])
-                    self.process_directory(oid, abspath)
+    def apply_dimensions(self):
+        """
+        Put the read dimensions to the table. Reschedules itself while some are not read yet
+        :return: None
+        """
+        while not self.dimensions.empty():
+            generation, item, dimensions = self.dimensions.get()
+            self.dimension_requests.discard(item)
+            if generation == self.scan_generation and self.table_frame.table.exists(item):
+                self.table_frame.table.set(item, 'Dimensions', dimensions)
+        if self.dimension_requests:
+            self.after(50, self.apply_dimensions)
+
+    def folder_opened(self, item):
+        """
+        Read the dimensions of the files of an opened folder
+        :param item: Table item of the folder
+        :return: None
+        """
+        self.request_dimensions([child for child in self.table_frame.table.get_children(item)
+                                 if self.table_frame.table.item(child)['tags'] == ['file']
+                                 and not self.table_frame.table.item(child)['values'][0]])
 
     def out(self):
         """
-        Resize images accordingly and generate output dict
+        Group the selected images by folders and generate output dict of lazily loaded images
         :return: None
         """
         if not self.files_selected:
             messagebox.showerror('Waring!', "Choose a folder(s) or an image(s) to continue!")
         else:
-            folder_name = []
-            counter = 0
-            # for ind, file in enumerate(self.files_selected):
-            for ind, file in tqdm(enumerate(self.files_selected), desc=f'Preparing images to work with', ncols=100,
-                                  unit='picture', colour='#ffc25c', total=len(self.files_selected), leave=False):
-                self.progress_bar.set(round((1 - (len(self.files_selected) - ind - 1) /
-                                             len(self.files_selected)), 2))
-                self.update_idletasks()
+            for file in self.files_selected:
                 dir_name = os.path.basename(Path(file).parents[0])
                 if 'Processed/' in file:
                     dir_name = Path(file.split('Processed/')[0]).name
-                folder_name.append(dir_name)
-                if ind != 0 and not folder_name[ind - 1] == folder_name[ind]:
-                    counter = 0
-                self.data[dir_name][counter] = {'Name': file,
-                                                'Image': self.resize_image(file),
-                                                'Image_original': Image.open(file).convert('RGB')}
-                counter += 1
+                self.data[dir_name].append(file)
+            providers = {dir_name: ImageProvider(files, self.zoom_rate, preview_cache=self.preview_cache)
+                         for dir_name, files in self.data.items()}
+            first_provider = next(iter(providers.values()))
+            first_provider.prefetch('Preview', min(self.first_img, len(first_provider) - 1))  # While the window opens
+            self.progress_bar.set(1)
             for widget in self.winfo_children():
                 widget.quit()
             self.pack_forget()
-            self.get_data(data=self.data, extension=self.extension, new_zoom=int(1 / self.zoom_rate),
+            self.get_data(data=providers, extension=self.extension, new_zoom=int(1 / self.zoom_rate),
                           first_img=self.first_img, highest_path=self.file_directory)
 
 
@@ -320,7 +425,7 @@ class FirstFrame(ctk.CTkFrame):
     def __init__(self, parent, width=200, height=200, fg_color='transparent', *args, **kwargs):
         super().__init__(master=parent, width=width, height=height, fg_color=fg_color, *args, **kwargs)
         self.parent = parent
-        self.extension_combox = ctk.CTkComboBox(self, values=['JPG', 'PNG'], width=70,
+        self.extension_combox = ctk.CTkComboBox(self, values=['JPG', 'PNG', 'WEBP'], width=70,
                                                 command=lambda event: self.parent.set_extension(event))
         self.expand = ctk.CTkButton(self, text='Expand all', width=20,
                                     command=lambda: self.parent.expand_collapse())
@@ -380,6 +485,7 @@ class TableFrame(ctk.CTkFrame):
         self.table.pack(side='left', fill='y')
         self.table_scrollbar.configure(command=self.table.yview)
         self.table.bind('<<TreeviewSelect>>', lambda event: self.parent.items_select())
+        self.table.bind('<<TreeviewOpen>>', lambda event: self.parent.folder_opened(self.table.focus()))
 
 
 class ProceedFrame(ctk.CTkFrame):
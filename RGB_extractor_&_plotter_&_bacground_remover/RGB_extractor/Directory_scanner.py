@@ -0,0 +1,76 @@
+import os
+import threading
+
+from natsort import natsorted
+
+
+class DirectoryScanner:
+    def __init__(self, path):
+        """
+        Scan a directory tree with os.scandir on a background thread, so slow network or cloud drives do not freeze
+        the GUI. Every entry of the top directory is appended to self.entries as soon as it is scanned completely, in
+        the natural order of names:
+        - a file is a tuple (name, path, size in bytes),
+        - a folder is a dict with 'Name', 'Path' and 'Entries' of the same kind.
+        The result covers all the files, so it may be filtered by any extension without scanning again.
+        :param path: Path to the top directory
+        """
+        self.path = path
+        self.entries = []
+        self.finished = threading.Event()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for entry in self.list_entries(self.path):
+                if self.cancelled.is_set():
+                    return
+                self.entries.append(entry)
+        finally:
+            self.finished.set()
+
+    def list_entries(self, path):
+        """
+        Scan a directory recursively
+        :param path: Path to the directory
+        :return: Generator of the entries in the natural order of names
+        """
+        try:
+            with os.scandir(path) as it:
+                dir_entries = natsorted(it, key=lambda e: e.name)
+        except OSError:  # No access, or the folder has been deleted meanwhile
+            return
+        for dir_entry in dir_entries:
+            if self.cancelled.is_set():
+                return
+            abspath = os.path.join(path, dir_entry.name).replace('\\', '/')
+            try:
+                if dir_entry.is_file():
+                    yield dir_entry.name, abspath, dir_entry.stat().st_size
+                elif dir_entry.is_dir():
+                    yield {'Name': dir_entry.name, 'Path': abspath, 'Entries': list(self.list_entries(abspath))}
+            except OSError:
+                continue
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @staticmethod
+    def has_files(folder, extension, is_skipped):
+        """
+        Check if a folder contains files with the extension, including nested folders. The result is cached in the
+        folder dict per extension
+        :param folder: Folder dict
+        :param extension: Extension of the files
+        :param is_skipped: Function telling if a file name must be ignored, e.g. a mask
+        :return: bool
+        """
+        matches = folder.setdefault('Matches', {})
+        if extension not in matches:
+            matches[extension] = any(
+                DirectoryScanner.has_files(entry, extension, is_skipped) if isinstance(entry, dict)
+                else entry[0].endswith(extension) and not is_skipped(entry[0])
+                for entry in folder['Entries'])
+        return matches[extension]
@@ -0,0 +1,178 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import ImageTk
+
+from Instruments import open_frame
+from Preview_cache import PreviewCache
+
+
+class ImageProvider:
+    def __init__(self, files, zoom_rate, cache_size=6, preview_cache_size=64, preview_cache=None):
+        """
+        Sequence of pictures loaded on demand for RGBExtractingCanvas instead of decoding all of them beforehand.
+        An item is a LazyFrame with the 'Name', 'Image', 'Preview' and 'Image_original' keys. Previews and originals
+        are loaded separately and kept in LRU caches. The neighbours of the shown picture are decoded on a background
+        thread, so moving forward and backward does not wait for decoding.
+        Tk images are created on the main thread only, the background thread works with PIL and NumPy.
+        :param files: Paths to the pictures
+        :param zoom_rate: Scale of the previews
+        :param cache_size: Number of decoded originals to keep, a 24 MP picture takes 72 MB
+        :param preview_cache_size: Number of previews to keep in memory
+        :param preview_cache: PreviewCache to keep the previews on disk between sessions. If None, the previews are
+                              made every time
+        """
+        self.files = list(files)
+        self.zoom_rate = zoom_rate
+        self.preview_cache = preview_cache
+        self.sizes = {'Preview': preview_cache_size, 'Original': cache_size}
+        self.caches = {'Preview': OrderedDict(), 'Original': OrderedDict()}
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Image_provider')
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        if not -len(self.files) <= index < len(self.files):
+            raise IndexError(f'Picture {index} out of {len(self.files)}')
+        return LazyFrame(self, index % len(self.files))
+
+    def photo(self, index):
+        """
+        Preview of a picture to show with Tkinter. Call from the main thread only.
+        Starts prefetching of the original to measure and of the neighbouring previews
+        :param index: Number of the picture
+        :return: ImageTk.PhotoImage
+        """
+        photo = ImageTk.PhotoImage(self.preview(index))
+        self.prefetch('Original', index, index + 1)
+        return photo
+
+    def preview(self, index):
+        """
+        Resized picture
+        :param index: Number of the picture
+        :return: PIL image. Copy it before drawing on it
+        """
+        preview = self.get('Preview', index)
+        self.prefetch('Preview', index + 1, index - 1)
+        return preview
+
+    def original(self, index):
+        """
+        Non-resized picture to extract the RGB values from
+        :param index: Number of the picture
+        :return: RGB array
+        """
+        original = self.get('Original', index)
+        self.prefetch('Original', index + 1)  # Auto-applying goes through the pictures one by one
+        return original
+
+    def get(self, kind, index):
+        """
+        Get a picture from the cache. If it is not there, decode it or wait for the background thread decoding it
+        :param kind: 'Preview' or 'Original'
+        :param index: Number of the picture
+        :return: Preview or original
+        """
+        with self.lock:
+            cache = self.caches[kind]
+            if index in cache:
+                cache.move_to_end(index)
+                return cache[index]
+            future = self.loading.get((kind, index))
+            owner = future is None
+            if owner:
+                future = self.loading[(kind, index)] = Future()
+        if owner:
+            self.decode(kind, index, future)
+        return future.result()
+
+    def prefetch(self, kind, *indexes):
+        """
+        Decode pictures on the background thread if they are not cached or being decoded
+        :param kind: 'Preview' or 'Original'
+        :param indexes: Numbers of the pictures
+        :return: None
+        """
+        for index in indexes:
+            if not 0 <= index < len(self.files):
+                continue
+            with self.lock:
+                if index in self.caches[kind] or (kind, index) in self.loading:
+                    continue
+                future = self.loading[(kind, index)] = Future()
+            self.executor.submit(self.decode, kind, index, future)
+
+    def decode(self, kind, index, future):
+        """
+        Decode a preview or an original and cache it
+        :param kind: 'Preview' or 'Original'
+        :param index: Number of the picture
+        :param future: Future to set the result to
+        :return: None
+        """
+        try:
+            if kind == 'Original':
+                value = np.asarray(open_frame(self.files[index]).convert('RGB'))
+            elif self.preview_cache:
+                value = self.preview_cache.preview(self.files[index], self.zoom_rate)
+            else:
+                value = PreviewCache.build(self.files[index], self.zoom_rate)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[(kind, index)]
+            future.set_exception(e)
+            return
+        with self.lock:
+            cache = self.caches[kind]
+            cache[index] = value
+            while len(cache) > self.sizes[kind]:
+                cache.popitem(last=False)
+            del self.loading[(kind, index)]
+        future.set_result(value)
+
+    def close(self):
+        """
+        Stop the background thread and free the caches
+        :return: None
+        """
+        self.executor.shutdown(cancel_futures=True)
+        with self.lock:
+            for cache in self.caches.values():
+                cache.clear()
+
+
+class LazyFrame(Mapping):
+    fields = ('Name', 'Image', 'Preview', 'Image_original')
+
+    def __init__(self, provider, index):
+        """
+        Picture entry of an ImageProvider. 'Name' is available at once, the images are loaded on access
+        :param provider: ImageProvider
+        :param index: Number of the picture
+        """
+        self.provider = provider
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == 'Name':
+            return self.provider.files[self.index]
+        if key == 'Image':
+            return self.provider.photo(self.index)
+        if key == 'Preview':
+            return self.provider.preview(self.index)
+        if key == 'Image_original':
+            return self.provider.original(self.index)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
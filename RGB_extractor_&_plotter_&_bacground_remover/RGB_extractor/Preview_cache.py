@@ -0,0 +1,177 @@
+import argparse
+import io
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from Instruments import find_mask, open_frame
+
+
+class PreviewCache:
+    default_path = Path.home() / '.cache' / 'RGB_previews.sqlite'
+
+    def __init__(self, cache_path=None, max_size_mb=2048, jpeg_quality=95):
+        """
+        On-disk cache of the resized previews shown by RGBExtractingCanvas, kept in a single SQLite file.
+        An entry is addressed by the path and the zoom rate and is valid while the modification time and the size of
+        the picture are the same, so a changed picture is never shown from an old entry. When the cache grows over
+        the limit, the least recently used entries are evicted on closing.
+        The cache may be used from several threads.
+
+        :param cache_path: Path to the SQLite file. Default is '~/.cache/RGB_previews.sqlite'
+        :param max_size_mb: Size limit of the cache in MB
+        :param jpeg_quality: Quality of the previews without transparency, which are stored as JPEG since it decodes
+                             several times faster than PNG. The previews with transparency are stored as PNG
+        """
+        self.cache_path = Path(cache_path) if cache_path else self.default_path
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 ** 2)
+        self.jpeg_quality = jpeg_quality
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS previews (path TEXT, zoom REAL, mtime_ns INTEGER, '
+                                'size INTEGER, data BLOB, used REAL, PRIMARY KEY (path, zoom))')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def build(path, zoom_rate):
+        """
+        Make a preview of a picture. JPEGs without a mask are decoded in the draft mode, directly at a reduced scale,
+        which is several times faster than decoding the full picture
+        :param path: Path to the picture
+        :param zoom_rate: Scale of the preview
+        :return: PIL image
+        """
+        if find_mask(path) is None:
+            image = Image.open(path)
+            size = int(image.width * zoom_rate), int(image.height * zoom_rate)
+            image.draft('RGB', size)  # Only JPEGs support it, other formats ignore it
+        else:
+            image = open_frame(path)
+            size = int(image.width * zoom_rate), int(image.height * zoom_rate)
+        return image.resize(size, resample=Image.Resampling.NEAREST,
+                            reducing_gap=None)  # Use filter NEAREST to increase performance
+
+    def preview(self, path, zoom_rate):
+        """
+        Get a preview from the cache or make and cache it
+        :param path: Path to the picture
+        :param zoom_rate: Scale of the preview
+        :return: PIL image
+        """
+        image = self.get(path, zoom_rate)
+        if image is None:
+            image = self.build(path, zoom_rate)
+            self.put(path, zoom_rate, image)
+        return image
+
+    def get(self, path, zoom_rate):
+        """
+        Read an entry and mark it as recently used
+        :param path: Path to the picture
+        :param zoom_rate: Scale of the preview
+        :return: PIL image or None if there is no valid entry
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), zoom_rate)
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM previews WHERE path=? AND zoom=? AND mtime_ns=? '
+                                          'AND size=?', (*key, stat.st_mtime_ns, stat.st_size)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE previews SET used=? WHERE path=? AND zoom=?', (time.time(), *key))
+            self.connection.commit()
+        image = Image.open(io.BytesIO(row[0]))
+        image.load()
+        return image
+
+    def put(self, path, zoom_rate, image):
+        """
+        Write an entry, replacing the old one of the picture
+        :param path: Path to the picture
+        :param zoom_rate: Scale of the preview
+        :param image: PIL image
+        :return: None
+        """
+        stat = os.stat(path)
+        data = io.BytesIO()
+        if image.mode in ('RGB', 'L'):
+            image.save(data, format='JPEG', quality=self.jpeg_quality)
+        else:
+            image.save(data, format='PNG', compress_level=1)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO previews VALUES (?, ?, ?, ?, ?, ?)',
+                                    (os.path.abspath(path), zoom_rate, stat.st_mtime_ns, stat.st_size,
+                                     data.getvalue(), time.time()))
+            self.connection.commit()
+
+    def entries(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM previews').fetchone()[0]
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM previews').fetchone()[0]
+
+    def evict(self, max_size=None):
+        """
+        Delete the least recently used entries until the cache fits the size limit
+        :param max_size: Size limit in bytes. Default is the one of the cache
+        :return: Number of deleted entries
+        """
+        max_size = self.max_size if max_size is None else max_size
+        with self.lock:
+            rows = self.connection.execute('SELECT path, zoom, LENGTH(data) FROM previews ORDER BY used').fetchall()
+            total = sum(row[2] for row in rows)
+            deleted = []
+            for path, zoom, size in rows:
+                if total <= max_size:
+                    break
+                deleted.append((path, zoom))
+                total -= size
+            self.connection.executemany('DELETE FROM previews WHERE path=? AND zoom=?', deleted)
+            self.connection.commit()
+            if deleted:
+                self.connection.execute('VACUUM')
+        return len(deleted)
+
+    def clear(self):
+        return self.evict(max_size=0)
+
+    def close(self):
+        """
+        Evict the entries over the size limit and close the file
+        :return: None
+        """
+        self.evict()
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or prune the cache of previews of the RGB extractor')
+    parser.add_argument('command', choices=['info', 'prune', 'clear'])
+    parser.add_argument('--path', default=None, help=f'Cache file. Default is {PreviewCache.default_path}')
+    parser.add_argument('--max-size-mb', type=float, default=2048, help='Size limit used by "prune"')
+    args = parser.parse_args()
+    cache = PreviewCache(args.path, args.max_size_mb)
+    if args.command == 'info':
+        print(f'Cache: {cache.cache_path}')
+        print(f'Entries: {cache.entries()}')
+        print(f'Size: {cache.size() / 1024 ** 2:.1f} MB of {args.max_size_mb} MB')
+    elif args.command == 'prune':
+        print(f'Deleted {cache.evict()} entries')
+    elif args.command == 'clear':
+        print(f'Deleted {cache.clear()} entries')
+    cache.connection.close()
@@ -7,9 +7,10 @@ from tkinter import messagebox
 
 import customtkinter as ctk
 import numpy as np
-from PIL import ImageDraw, ImageTk, ImageFont
+from PIL import ImageDraw, ImageFont
 from tqdm import tqdm
 
+from Area_statistics import AreaStatistics
 from Instruments import create_folder, get_newest_file, recursive_default_dict
 
 
@@ -18,8 +19,11 @@ class RGBExtractingCanvas(ctk.CTkFrame):
     height = 1200
 
     def __init__(self, parent, folder, data, zoom, extension, current_folder, data_len, start_from=0,
-                 *args, **kwargs):
+                 area_tables=False, *args, **kwargs):
         super().__init__(master=parent, *args, **kwargs)
+        # Summed-area tables of the shown image for the live RGB readout. They are built on a background thread
+        # once a picture is shown, until then the areas are sliced from the picture
+        self.area_statistics = AreaStatistics() if area_tables else None
         self.zoom_index = zoom
         self.auto_applying_flag = False
         self.folder_suffix = folder
@@ -62,8 +66,23 @@ class RGBExtractingCanvas(ctk.CTkFrame):
         self.canvas.bind('<B1-Motion>', lambda event: self.update_sel_rect(event))
         self.canvas.bind_all("<KeyPress>", self.main_method)
         self.canvas.update()
+        self.prepare_area_tables()
         self.mainloop()
 
+    def destroy(self):
+        if self.area_statistics:
+            self.area_statistics.close()
+        super().destroy()
+
+    def prepare_area_tables(self):
+        """
+        Start building the summed-area tables of the shown picture, so the live readout does not freeze the window
+        :return: None
+        """
+        if self.area_statistics:
+            counter = self.counter
+            self.area_statistics.prepare(counter, lambda: self.raw_data[counter]['Image_original'])
+
     def make_folder(self):
         if self.parent_path.endswith('Processed/'):
             self.parent_path = self.parent_path.split('Processed/')[0]
@@ -96,24 +115,46 @@ class RGBExtractingCanvas(ctk.CTkFrame):
         """
         self.bot_x, self.bot_y = event.x, event.y
         self.canvas.coords(self.rectangle, self.top_x, self.top_y, self.bot_x, self.bot_y)
+        if self.area_statistics:
+            self.show_readout()
 
-    def get_rgb_pil(self, counter=None):
+    def show_readout(self):
+        """
+        Show the average RGB and its standard deviation of the area being drawn next to the cursor
+        :return: None
+        """
+        (r, g, b), (r_std, g_std, b_std) = self.get_rgb_statistics()
+        self.canvas.delete('readout')
+        if np.isnan(r):
+            return
+        self.canvas.create_text(self.bot_x + 15, self.bot_y + 15, anchor='nw', font=self.tk_font, fill='white',
+                                text=f'R {r:.1f}±{r_std:.1f}\nG {g:.1f}±{g_std:.1f}\nB {b:.1f}±{b_std:.1f}',
+                                tags='readout')
+
+    def get_rgb_statistics(self, counter=None):
         """
-        Extracting the RGB values from pure non-resized image over a given rectangular area. Pillow version.
-        This has to be faster than cv2.
+        Average RGB values and their standard deviations over a given rectangular area of pure non-resized image.
+        Both corners are included. The parts outside the image are cut off.
+        The summed-area tables are used for the shown image if enabled and built already, other images are sliced,
+        since building a table only pays off for many areas of the same image
         :param counter: If passed changes the 'self.counter'
-        :return: R, G, and B average values
+        :return: [R, G, B] averages and [R, G, B] standard deviations
         """
         if counter is None:
             counter = self.counter
-        pixels_list = []
+        top, left = self.top_y * self.zoom_index, self.top_x * self.zoom_index
+        bottom, right = self.bot_y * self.zoom_index, self.bot_x * self.zoom_index
+        if self.area_statistics:
+            statistics = self.area_statistics.statistics(counter, top, left, bottom, right)
+            if statistics is not None:
+                return statistics
         img = self.raw_data[counter]['Image_original']
-        for x in range(self.top_x * self.zoom_index, self.bot_x * self.zoom_index + 1):
-            for y in range(self.top_y * self.zoom_index, self.bot_y * self.zoom_index + 1):
-                h = img.getpixel((x, y))
-                pixels_list.append(h)
-        r, g, b = np.mean(pixels_list, axis=0)
-        return [r, g, b]
+        top, left = max(top, 0), max(left, 0)
+        bottom, right = max(min(bottom + 1, img.shape[0]), 0), max(min(right + 1, img.shape[1]), 0)
+        area = img[top:bottom, left:right]  # Clamped, so negative corners do not wrap around
+        if not area.size:
+            return [np.nan] * 3, [np.nan] * 3
+        return list(area.mean(axis=(0, 1))), list(area.std(axis=(0, 1)))
 
     @staticmethod
     def get_outline_box_color(average_rgb):
@@ -157,9 +198,11 @@ class RGBExtractingCanvas(ctk.CTkFrame):
             area_number = int(event.char)
             self.canvas.delete(f'Area_{area_number}')
             self.canvas.delete(f'Area_{area_number}_text')
-            avr_rgb = self.get_rgb_pil()
+            self.canvas.delete('readout')
+            avr_rgb, std_rgb = self.get_rgb_statistics()
             self.data_dict[self.counter][f'Area {area_number}'] |= \
-                {'RGB': {'R': avr_rgb[0], 'G': avr_rgb[1], 'B': avr_rgb[2]}}
+                {'RGB': {'R': avr_rgb[0], 'G': avr_rgb[1], 'B': avr_rgb[2]},
+                 'RGB_std': {'R': std_rgb[0], 'G': std_rgb[1], 'B': std_rgb[2]}}
             self.data_dict[self.counter][f'Area {area_number}'] |= \
                 {'Coordinates': {'1top_x': self.top_x, '2top_y': self.top_y, '3bot_x': self.bot_x,
                                  '4bot_y': self.bot_y}}
@@ -215,6 +258,7 @@ class RGBExtractingCanvas(ctk.CTkFrame):
                 self.rectangle = self.canvas.create_rectangle(self.top_x, self.top_y, self.bot_x, self.bot_y,
                                                               fill='', outline='white', width=5, tags='rectangle')
                 self.canvas.update()
+                self.prepare_area_tables()
             else:
                 for widget in self.winfo_children():
                     widget.quit()
@@ -237,6 +281,7 @@ class RGBExtractingCanvas(ctk.CTkFrame):
                 self.rectangle = self.canvas.create_rectangle(self.top_x, self.top_y, self.bot_x, self.bot_y,
                                                               fill='', outline='white', width=5, tags='rectangle')
                 self.canvas.update()
+                self.prepare_area_tables()
             else:
                 messagebox.showinfo(title='Info', message='This is the first image.')
 
@@ -252,12 +297,13 @@ class RGBExtractingCanvas(ctk.CTkFrame):
                 self.top_y = self.data_dict[counter][area]['Coordinates']['2top_y']
                 self.bot_x = self.data_dict[counter][area]['Coordinates']['3bot_x']
                 self.bot_y = self.data_dict[counter][area]['Coordinates']['4bot_y']
-                avr_rgb = self.get_rgb_pil(counter=picture)
+                avr_rgb, std_rgb = self.get_rgb_statistics(counter=picture)
                 self.outline[picture][area] = self.get_outline_box_color(avr_rgb)[0]
                 self.data_dict[picture][area] = {
                     'Coordinates': {'1top_x': self.top_x, '2top_y': self.top_y,
                                     '3bot_x': self.bot_x, '4bot_y': self.bot_y},
-                    'RGB': {'R': avr_rgb[0], 'G': avr_rgb[1], 'B': avr_rgb[2]}}
+                    'RGB': {'R': avr_rgb[0], 'G': avr_rgb[1], 'B': avr_rgb[2]},
+                    'RGB_std': {'R': std_rgb[0], 'G': std_rgb[1], 'B': std_rgb[2]}}
 
     def save_image_with_areas_after(self):
         """
@@ -277,7 +323,7 @@ class RGBExtractingCanvas(ctk.CTkFrame):
                 if str(img_index) not in json_data:  # Check if the image index exists in json_data
                     continue
 
-                img_pil = ImageTk.getimage(self.raw_data[img_index]['Image'])
+                img_pil = self.raw_data[img_index]['Preview'].convert('RGBA')
                 draw_tool = ImageDraw.Draw(img_pil)
 
                 for area_key, area_values in json_data[f'{img_index}'].items():